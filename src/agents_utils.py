@@ -3,12 +3,29 @@ Winston Chen
 5/3/2021
 Utilities for trolly agents' logic setup
 """
-import random
 import numpy as np
+from sim_utils import make_rng
+
+# number of table cells evaluated per decide_batch call while compiling
+COMPILE_CHUNK_CELLS = 2**20
+# largest lookup table (in cells, 1 byte each) compile builds, the source
+# agent decides on larger input domains
+MAX_TABLE_CELLS = 2**26
 
 
 class BaseAgent:
+    # whether make_decision is a pure function of its inputs
+    deterministic = False
+    # whether the simulator calls update_batch after every batch of trials
+    learning = False
+
     def __init__(self, seed, pass_max=5, track_max=5):
+        """
+        seed: random seed (int, SeedSequence or Generator) of the agent's
+              own random stream
+        pass_max: maximum possible number of passengers on a trolly
+        track_max: maximum possible number of people tied on one track
+        """
         self.pass_max = pass_max
         self.track_max = track_max
 
@@ -16,7 +33,7 @@ class BaseAgent:
         self.def_track_num = None
         self.alt_track_num = None
 
-        random.seed(seed)
+        self.rng = make_rng(seed)
 
     def set_pass_num(self, num):
         """set the number of passengers on the agent"""
@@ -41,38 +58,133 @@ class BaseAgent:
            or (self.alt_track_num is None):
             raise ValueError("Insufficient Information")
 
+    def batch_key(self):
+        """
+        agents with equal batch keys make the same decisions on the same
+        inputs, so the simulator groups them and calls decide_batch once on
+        any member of the group
+        every agent gets a key of its own (its parameters may differ from
+        the ones of other agents of its class), agents without per-object
+        parameters override this with a shared key
+        """
+        return id(self)
+
+    def compile(self, full_info=1):
+        """
+        lookup table version of this deterministic agent for one information
+        mode, the agent itself if that table would exceed MAX_TABLE_CELLS
+        """
+        if np.prod(CompiledAgent.table_shape(self.pass_max, self.track_max,
+                                             full_info)) > MAX_TABLE_CELLS:
+            return self
+        return CompiledAgent(self)
+
+    def switch_prob_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                          def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        """
+        probability of switching for every entry of the given 1d arrays,
+        same arguments as decide_batch
+        deterministic agents switch with probability 0 or 1, other agents
+        need to override this to be solved exactly
+        """
+        if not self.deterministic:
+            raise ValueError(f"switch probability of {self} is unknown")
+        return self.decide_batch(pass_nums, def_track_nums, alt_track_nums,
+                                 def_neigh_pass_nums,
+                                 alt_neigh_pass_nums).astype(float)
+
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        """
+        make one decision for every entry of the given 1d arrays, entries
+        may come from different trollies and different trials
+        pass_nums: number of passengers on the agent
+        def_track_nums: number of people on the default track
+        alt_track_nums: number of people on the alternative track
+        def_neigh_pass_nums, alt_neigh_pass_nums: number of passengers on the
+            neighbors (None if the agent doesn't have full information)
+        return: integer array of decisions (0 - stay, 1 - switch)
+        fall back to make_decision one entry at a time, agents override this
+        with a vectorized version
+        """
+        decisions = np.empty(len(pass_nums), dtype=np.int64)
+        for i in range(len(pass_nums)):
+            self.set_pass_num(pass_nums[i])
+            self.set_track_nums(def_num=def_track_nums[i],
+                                alt_num=alt_track_nums[i])
+            if def_neigh_pass_nums is None or alt_neigh_pass_nums is None:
+                decisions[i] = self.make_decision()
+            else:
+                decisions[i] = self.make_decision(def_neigh_pass_nums[i],
+                                                  alt_neigh_pass_nums[i])
+        return decisions
+
 
 class RandomAgent(BaseAgent):
     def __str__(self):
         return "RandomAgent"
 
+    def batch_key(self):
+        return (type(self), self.pass_max, self.track_max)
+
     def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
         self.check_info()
-        return random.randint(0, 1)
+        return int(self.rng.integers(0, 2))
+
+    def switch_prob_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                          def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        return np.full(len(pass_nums), 0.5)
+
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        return self.rng.integers(0, 2, size=len(pass_nums))
 
 
 class AlwaysDoNothingAgent(BaseAgent):
+    deterministic = True
+
     def __str__(self):
         return "AlwaysDoNothingAgent"
 
+    def batch_key(self):
+        return (type(self), self.pass_max, self.track_max)
+
     def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
         self.check_info()
         return 0
 
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        return np.zeros(len(pass_nums), dtype=np.int64)
+
 
 class AlwaysSwitchAgent(BaseAgent):
+    deterministic = True
+
     def __str__(self):
         return "AlwaysSwitchAgent"
 
+    def batch_key(self):
+        return (type(self), self.pass_max, self.track_max)
+
     def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
         self.check_info()
         return 1
 
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        return np.ones(len(pass_nums), dtype=np.int64)
+
 
 class TrackLifeAgent(BaseAgent):
+    deterministic = True
+
     def __str__(self):
         return "TrackLifeAgent"
 
+    def batch_key(self):
+        return (type(self), self.pass_max, self.track_max)
+
     def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
         self.check_info()
         if self.def_track_num > self.alt_track_num:
@@ -80,19 +192,33 @@ class TrackLifeAgent(BaseAgent):
         else:
             return 0
 
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        return (np.asarray(def_track_nums) > np.asarray(alt_track_nums)).astype(np.int64)
+
 
 class StatAgent(BaseAgent):
+    deterministic = True
+
+    def __init__(self, seed, pass_max=5, track_max=5):
+        super().__init__(seed, pass_max=pass_max, track_max=track_max)
+        # expected neighbor passenger number used when it's unknown
+        self.E_pass_num = np.sum([i for i in range(self.pass_max+1)])/self.pass_max
+
     def __str__(self):
         return "StatAgent"
 
+    def batch_key(self):
+        return (type(self), self.pass_max, self.track_max)
+
     def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
         self.check_info()
         if def_neigh_pass_num and alt_neigh_pass_num:
             E_def_neigh_pass_num = def_neigh_pass_num
             E_alt_neighbor_pass_num = alt_neigh_pass_num
         else:
-            E_def_neigh_pass_num = np.sum([i for i in range(self.pass_max+1)])/self.pass_max
-            E_alt_neighbor_pass_num = np.sum([i for i in range(self.pass_max+1)])/self.pass_max
+            E_def_neigh_pass_num = self.E_pass_num
+            E_alt_neighbor_pass_num = self.E_pass_num
 
         E_loss_stay = (2*self.def_track_num+self.pass_num+E_def_neigh_pass_num)/2
         E_loss_switch = (2*self.alt_track_num+self.pass_num+E_alt_neighbor_pass_num)/2
@@ -101,3 +227,249 @@ class StatAgent(BaseAgent):
             return 1
         else:
             return 0
+
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        E_pass_num = self.E_pass_num
+        if def_neigh_pass_nums is None or alt_neigh_pass_nums is None:
+            E_def_neigh_pass_nums = E_pass_num
+            E_alt_neighbor_pass_nums = E_pass_num
+        else:
+            # same as make_decision, neighbors with 0 passengers fall back
+            # to the expected passenger number
+            def_neigh_pass_nums = np.asarray(def_neigh_pass_nums, dtype=np.int64)
+            alt_neigh_pass_nums = np.asarray(alt_neigh_pass_nums, dtype=np.int64)
+            known = (def_neigh_pass_nums != 0) & (alt_neigh_pass_nums != 0)
+            E_def_neigh_pass_nums = np.where(known, def_neigh_pass_nums, E_pass_num)
+            E_alt_neighbor_pass_nums = np.where(known, alt_neigh_pass_nums, E_pass_num)
+
+        # the inputs may be compact draws, upcast before scaling and adding
+        pass_nums = np.asarray(pass_nums, dtype=np.int64)
+        E_loss_stay = (2*np.asarray(def_track_nums, dtype=np.int64)+pass_nums
+                       + E_def_neigh_pass_nums)/2
+        E_loss_switch = (2*np.asarray(alt_track_nums, dtype=np.int64)+pass_nums
+                         + E_alt_neighbor_pass_nums)/2
+        return (E_loss_stay > E_loss_switch).astype(np.int64)
+
+
+class LearningAgent(BaseAgent):
+    """
+    tabular contextual bandit learning the expected loss of staying and
+    switching in every state (pass_num, def_track_num, alt_track_num and,
+    with full information, the 2 neighbor passenger numbers) from the losses
+    it causes, instead of assuming a passenger distribution like StatAgent
+    all learning agents of a simulator with the same parameters share one
+    table (same batch key), every batch of trials updates it at once
+    """
+    learning = True
+
+    def __init__(self, seed, pass_max=5, track_max=5, epsilon=0.1,
+                 loss_type="teleology", num_replicates=1):
+        """
+        epsilon: probability of exploring a uniformly random decision
+        loss_type: loss to minimize, "teleology" (everyone killed by the
+                   trolly) or "deontology" (its own passengers killed)
+        num_replicates: number of independent tables, see set_num_replicates
+        """
+        super().__init__(seed, pass_max=pass_max, track_max=track_max)
+        if loss_type not in ["teleology", "deontology"]:
+            raise ValueError(f"unknown loss_type={loss_type}")
+        self.epsilon = epsilon
+        self.loss_type = loss_type
+        pass_dim = pass_max+1
+        track_dim = track_max+1
+        self.state_dims = {False: (pass_dim, track_dim, track_dim),
+                           True: (pass_dim, track_dim, track_dim, pass_dim, pass_dim)}
+        self.set_num_replicates(num_replicates)
+
+    def __str__(self):
+        return "LearningAgent"
+
+    def batch_key(self):
+        return (type(self), self.pass_max, self.track_max, self.epsilon,
+                self.loss_type)
+
+    def set_num_replicates(self, num_replicates):
+        """
+        start over with one empty table per replicate, the batch methods
+        pick the table of every entry with replicate_idx (table 0 if None)
+        so independent replicates learn with one call (see EvolutionEngine)
+        """
+        self.num_replicates = num_replicates
+        # (R, #states, 2) summed loss and number of samples of every
+        # (replicate, state, decision) by information mode, allocated on
+        # first use, unseen pairs have an optimistic 0 expected loss
+        self.loss_sums = {}
+        self.counts = {}
+
+    def tables(self, full_info):
+        """return: (loss_sums, counts) tables of an information mode"""
+        if full_info not in self.counts:
+            shape = (self.num_replicates, int(np.prod(self.state_dims[full_info])), 2)
+            self.loss_sums[full_info] = np.zeros(shape)
+            self.counts[full_info] = np.zeros(shape, dtype=np.int64)
+        return self.loss_sums[full_info], self.counts[full_info]
+
+    def state_idx(self, pass_nums, def_track_nums, alt_track_nums,
+                  def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        """return: (full_info, flat state index of every entry)"""
+        full_info = def_neigh_pass_nums is not None and alt_neigh_pass_nums is not None
+        inputs = [pass_nums, def_track_nums, alt_track_nums]
+        if full_info:
+            inputs += [def_neigh_pass_nums, alt_neigh_pass_nums]
+        return full_info, np.ravel_multi_index(
+            tuple(np.asarray(arr, dtype=np.intp) for arr in inputs),
+            self.state_dims[full_info])
+
+    def expected_losses(self, full_info, state, replicate_idx=None):
+        """return: (len(state), 2) mean loss of staying and switching so far"""
+        loss_sums, counts = self.tables(full_info)
+        cells = state if replicate_idx is None \
+            else np.asarray(replicate_idx) * counts.shape[1] + state
+        counts = np.take(counts.reshape(-1, 2), cells, axis=0)
+        return np.divide(np.take(loss_sums.reshape(-1, 2), cells, axis=0), counts,
+                         out=np.zeros(counts.shape), where=counts > 0)
+
+    def greedy_batch(self, *inputs, replicate_idx=None):
+        full_info, state = self.state_idx(*inputs)
+        losses = self.expected_losses(full_info, state, replicate_idx)
+        # ties stay, like the heuristic agents
+        return (losses[:, 1] < losses[:, 0]).astype(np.int64)
+
+    def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
+        self.check_info()
+        neigh = [] if def_neigh_pass_num is None or alt_neigh_pass_num is None \
+            else [[def_neigh_pass_num], [alt_neigh_pass_num]]
+        return int(self.decide_batch([self.pass_num], [self.def_track_num],
+                                     [self.alt_track_num], *neigh)[0])
+
+    def switch_prob_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                          def_neigh_pass_nums=None, alt_neigh_pass_nums=None,
+                          replicate_idx=None):
+        greedy = self.greedy_batch(pass_nums, def_track_nums, alt_track_nums,
+                                   def_neigh_pass_nums, alt_neigh_pass_nums,
+                                   replicate_idx=replicate_idx)
+        return self.epsilon/2 + (1-self.epsilon) * greedy
+
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None,
+                     replicate_idx=None):
+        """
+        replicate_idx: table of every entry, see set_num_replicates
+        """
+        decisions = self.greedy_batch(pass_nums, def_track_nums, alt_track_nums,
+                                      def_neigh_pass_nums, alt_neigh_pass_nums,
+                                      replicate_idx=replicate_idx)
+        explore = self.rng.random(len(decisions)) < self.epsilon
+        decisions[explore] = self.rng.integers(0, 2, size=int(explore.sum()))
+        return decisions
+
+    def update_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums, alt_neigh_pass_nums, decisions,
+                     pass_kills, track_kills, replicate_idx=None):
+        """
+        fold the outcome of a batch of decisions into the shared table,
+        entries are aligned with decide_batch (neighbor arrays None without
+        full information)
+        decisions: decision made for every entry
+        pass_kills, track_kills: passengers and track people killed
+        replicate_idx: table of every entry, see set_num_replicates
+        """
+        full_info, state = self.state_idx(pass_nums, def_track_nums,
+                                          alt_track_nums, def_neigh_pass_nums,
+                                          alt_neigh_pass_nums)
+        loss_sums, counts = self.tables(full_info)
+        losses = np.asarray(pass_kills, dtype=float)
+        if self.loss_type == "teleology":
+            losses = losses + np.asarray(track_kills)
+        # flat (replicate, state, decision) cell of every entry, summed with
+        # one bincount, or scattered in place when the entries are much
+        # fewer than the cells (many replicates)
+        flat_idx = state * 2 + np.asarray(decisions)
+        if replicate_idx is not None:
+            flat_idx += np.asarray(replicate_idx) * (counts.shape[1] * 2)
+        if len(flat_idx) * 4 < counts.size:
+            np.add.at(loss_sums.reshape(-1), flat_idx, losses)
+            np.add.at(counts.reshape(-1), flat_idx, 1)
+        else:
+            loss_sums += np.bincount(flat_idx, weights=losses,
+                                     minlength=counts.size).reshape(counts.shape)
+            counts += np.bincount(flat_idx, minlength=counts.size).reshape(counts.shape)
+
+
+class CompiledAgent(BaseAgent):
+    """
+    lookup table version of a deterministic agent, the source agent is
+    evaluated once over the whole input domain of an information mode (on
+    its first use) and every decision after that is a single fancy-index
+    into a uint8 table
+    """
+    deterministic = True
+
+    def __init__(self, agent):
+        """
+        agent: deterministic agent to compile
+        """
+        if not agent.deterministic:
+            raise ValueError(f"can't compile non deterministic agent {agent}")
+        super().__init__(agent.rng, pass_max=agent.pass_max,
+                         track_max=agent.track_max)
+        self.source = agent
+        # decision table by full_info, see table
+        self.tables = {}
+
+    @staticmethod
+    def table_shape(pass_max, track_max, full_info):
+        """
+        return: shape of the table without neighbor information, indexed by
+                [pass_num, def_track_num, alt_track_num], or with it,
+                indexed by [..., def_neigh_pass_num, alt_neigh_pass_num]
+        """
+        shape = (pass_max+1, track_max+1, track_max+1)
+        return shape + (pass_max+1, pass_max+1) if full_info else shape
+
+    def table(self, full_info):
+        """decision table of an information mode, built chunk by chunk"""
+        full_info = bool(full_info)
+        if full_info not in self.tables:
+            shape = self.table_shape(self.pass_max, self.track_max, full_info)
+            table = np.empty(int(np.prod(shape)), dtype=np.uint8)
+            for start in range(0, table.size, COMPILE_CHUNK_CELLS):
+                stop = min(start + COMPILE_CHUNK_CELLS, table.size)
+                table[start:stop] = self.source.decide_batch(
+                    *np.unravel_index(np.arange(start, stop), shape))
+            self.tables[full_info] = table.reshape(shape)
+        return self.tables[full_info]
+
+    @property
+    def part_info_table(self):
+        return self.table(False)
+
+    @property
+    def full_info_table(self):
+        return self.table(True)
+
+    def __str__(self):
+        return str(self.source)
+
+    def batch_key(self):
+        return ("compiled", self.source.batch_key())
+
+    def compile(self, full_info=1):
+        return self
+
+    def make_decision(self, def_neigh_pass_num=None, alt_neigh_pass_num=None):
+        self.check_info()
+        if def_neigh_pass_num is None or alt_neigh_pass_num is None:
+            return int(self.part_info_table[self.pass_num, self.def_track_num,
+                                            self.alt_track_num])
+        return int(self.full_info_table[self.pass_num, self.def_track_num,
+                                        self.alt_track_num, def_neigh_pass_num,
+                                        alt_neigh_pass_num])
+
+    def decide_batch(self, pass_nums, def_track_nums, alt_track_nums,
+                     def_neigh_pass_nums=None, alt_neigh_pass_nums=None):
+        if def_neigh_pass_nums is None or alt_neigh_pass_nums is None:
+            return self.part_info_table[pass_nums, def_track_nums, alt_track_nums]
+        return self.full_info_table[pass_nums, def_track_nums, alt_track_nums,
+                                    def_neigh_pass_nums, alt_neigh_pass_nums]
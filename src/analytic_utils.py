@@ -0,0 +1,131 @@
+"""
+Exact expected losses of a trolly ring
+
+Every kill on the ring happens on one track j, which can only be chosen by
+its two neighboring trollies j-1 (switching) and j (staying). Their decisions
+only depend on the passengers of trollies j-2..j+1 and the people on tracks
+j-1..j+1, so by linearity of expectation the expected kills of the whole ring
+are a sum over adjacent trolly pairs of expectations over that small window.
+Each window is enumerated exactly over the uniform track/passenger draws,
+pairs of the same agent types share one enumeration, so a ring costs
+O(n + #pair types * (pass_max+1)^4 * (track_max+1)^3).
+"""
+import numpy as np
+
+
+def _pair_window_stats(sim, a, b):
+    """
+    expected per-trial kill stats on the track shared by trolly a and its
+    next trolly b
+    return: dict of
+        track_kill - people killed on the shared track
+        pass_kill - passengers killed by a collision on the shared track
+        a_pass_kill, a_track_kill - kills of trolly a when it switches
+        b_pass_kill, b_track_kill - kills of trolly b when it stays
+    """
+    n = sim.n
+    agent_a = sim.get_trolly_by_idx(a)
+    agent_b = sim.get_trolly_by_idx(b)
+    pass_idx = [(a-1) % n, a, b, (b+1) % n]
+    track_idx = [a, b, (b+1) % n]
+    # small rings alias some of the window variables, only enumerate the
+    # distinct ones
+    pass_vars = list(dict.fromkeys(pass_idx))
+    track_vars = list(dict.fromkeys(track_idx))
+    grids = np.meshgrid(*([np.arange(sim.pass_max+1)] * len(pass_vars)
+                          + [np.arange(sim.track_max+1)] * len(track_vars)),
+                        indexing="ij")
+    pass_nums = {var: grid.ravel()
+                 for var, grid in zip(pass_vars, grids[:len(pass_vars)])}
+    track_nums = {var: grid.ravel()
+                  for var, grid in zip(track_vars, grids[len(pass_vars):])}
+
+    if sim.full_info:
+        a_neigh = (pass_nums[pass_idx[0]], pass_nums[b])
+        b_neigh = (pass_nums[a], pass_nums[pass_idx[3]])
+    else:
+        a_neigh = b_neigh = ()
+    # decisions are independent given the window, so joint outcomes are
+    # products of the switch probabilities
+    q_a = agent_a.switch_prob_batch(pass_nums[a], track_nums[a],
+                                    track_nums[b], *a_neigh)
+    q_b = agent_b.switch_prob_batch(pass_nums[b], track_nums[b],
+                                    track_nums[track_idx[2]], *b_neigh)
+    collide = q_a * (1-q_b)
+    return {
+        "track_kill": np.mean(track_nums[b] * (1 - (1-q_a) * q_b)),
+        "pass_kill": np.mean((pass_nums[a] + pass_nums[b]) * collide),
+        "a_pass_kill": np.mean(pass_nums[a] * collide),
+        "a_track_kill": np.mean(track_nums[b] * q_a),
+        "b_pass_kill": np.mean(pass_nums[b] * collide),
+        "b_track_kill": np.mean(track_nums[b] * (1-q_b)),
+    }
+
+
+def expected_stats(sim):
+    """
+    sim: Simulator with every trolly set, agents must either be
+         deterministic or provide switch_prob_batch
+    return: dict with the expected value of one trial of every Simulator
+            accumulator (total_pass, total_track, total_pass_kill,
+            total_track_kill, trolly_pass_kills, trolly_track_kills,
+            trolly_pass_tot, trolly_track_tot)
+    """
+    n = sim.n
+    if n < 2:
+        raise ValueError(f"exact solver needs at least 2 trollies, n={n}")
+    if not sim.topology.is_ring:
+        raise ValueError("exact solver only supports the ring topology")
+    trolly_pass_kills = np.zeros(n)
+    trolly_track_kills = np.zeros(n)
+    total_pass_kill = 0.0
+    total_track_kill = 0.0
+    cache = {}
+    for a in range(n):
+        b = (a+1) % n
+        key = (sim.get_trolly_by_idx(a).batch_key(),
+               sim.get_trolly_by_idx(b).batch_key())
+        if key not in cache:
+            cache[key] = _pair_window_stats(sim, a, b)
+        stats = cache[key]
+        total_pass_kill += stats["pass_kill"]
+        total_track_kill += stats["track_kill"]
+        trolly_pass_kills[a] += stats["a_pass_kill"]
+        trolly_track_kills[a] += stats["a_track_kill"]
+        trolly_pass_kills[b] += stats["b_pass_kill"]
+        trolly_track_kills[b] += stats["b_track_kill"]
+
+    mean_pass = sim.pass_max / 2
+    mean_track = sim.track_max / 2
+    return {
+        "total_pass": n * mean_pass,
+        "total_track": n * mean_track,
+        "total_pass_kill": total_pass_kill,
+        "total_track_kill": total_track_kill,
+        "trolly_pass_kills": trolly_pass_kills,
+        "trolly_track_kills": trolly_track_kills,
+        "trolly_pass_tot": np.full(n, mean_pass),
+        "trolly_track_tot": np.full(n, 2 * mean_track),
+    }
+
+
+def expected_losses(sim, idx_arr=None):
+    """
+    exact counterpart of get_tot_*_loss / get_*_loss_by_idx
+    idx_arr: trolly indices or boolean mask, None for the whole ring
+    return: {"tele": teleology loss, "deon": deontology loss}
+    """
+    stats = expected_stats(sim)
+    if idx_arr is None:
+        kills = stats["total_pass_kill"] + stats["total_track_kill"]
+        ecounter = stats["total_pass"] + stats["total_track"]
+        return {"tele": float(kills / ecounter),
+                "deon": float(stats["total_pass_kill"] / stats["total_pass"])}
+
+    idx_arr = sim._as_index(idx_arr)
+    pass_kills = stats["trolly_pass_kills"][idx_arr].sum()
+    kills = pass_kills + stats["trolly_track_kills"][idx_arr].sum()
+    pass_tot = stats["trolly_pass_tot"][idx_arr].sum()
+    ecounter = pass_tot + stats["trolly_track_tot"][idx_arr].sum()
+    return {"tele": float(kills / ecounter) if ecounter else float("nan"),
+            "deon": float(pass_kills / pass_tot) if pass_tot else float("nan")}
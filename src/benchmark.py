@@ -0,0 +1,186 @@
+"""
+Throughput benchmarks of the trolly simulator
+
+usage (from src/):
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --baseline bench.json
+
+Every case reports its best trials/sec over a few repeats (after a warm-up
+run) and the peak memory traced in a separate run, the results are saved as json and compared against a stored baseline, the script
+exits with status 1 if any case got slower than the tolerance allows.
+"""
+import argparse, contextlib, io, json, platform, sys, time, tracemalloc
+import numpy as np
+from main import AGENT_CONS_ARR, new_agent, mix_comp_cell
+from sim_utils import Simulator, LossType
+from shard_utils import ShardedSimulator
+
+N_ARR = [2, 10, 100, 1000, 10000, 100000]
+QUICK_N_ARR = [2, 100, 10000]
+COMP_N_ARR = [10, 100]
+# number of trolly decisions per case, the trial count scales down with n
+CELL_BUDGET = 2 * 10**6
+# timing repeats of a case (the best one is kept) and the least time each
+# repeat runs the case for
+REPEATS = 5
+MIN_SECONDS = 0.2
+
+
+def build_population(population, n, seed=0):
+    """
+    homo: n StatAgents (the most expensive built-in policy)
+    mix: balanced mix of every agent type, shuffled as in mix_exp
+    """
+    agent_seed_seq = np.random.SeedSequence(seed)
+    if population == "homo":
+        return [new_agent(AGENT_CONS_ARR[-1], agent_seed_seq) for i in range(n)]
+    agent_arr = [new_agent(AGENT_CONS_ARR[i % len(AGENT_CONS_ARR)], agent_seed_seq)
+                 for i in range(n)]
+    order = np.random.default_rng(seed).permutation(n)
+    return [agent_arr[i] for i in order]
+
+
+def measure(name, fn, num_trials, repeats=REPEATS, min_seconds=MIN_SECONDS,
+            **info):
+    """
+    time fn (num_trials trials per call) after a warm-up call, the best of
+    repeats timings each running fn at least min_seconds, then trace its
+    peak memory in a separate call so tracemalloc doesn't slow the timing
+    """
+    fn()
+    best = np.inf
+    for i in range(repeats):
+        num_calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            num_calls += 1
+            seconds = time.perf_counter() - start
+            if seconds >= min_seconds:
+                break
+        best = min(best, seconds / num_calls)
+    tracemalloc.start()
+    fn()
+    _, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {"name": name, **info, "trials": num_trials, "seconds": best,
+              "trials_per_sec": num_trials / best,
+              "peak_mem_bytes": peak_mem}
+    print(f"{name}: {result['trials_per_sec']:.1f} trials/sec, "
+          f"peak mem={peak_mem/2**20:.1f}MB", file=sys.stderr)
+    return result
+
+
+def bench_run_trials(n_arr, **timing):
+    results = []
+    for n in n_arr:
+        num_trials = max(1, min(1000, CELL_BUDGET // n))
+        for population in ["homo", "mix"]:
+            for full_info in [0, 1]:
+                simulator = Simulator(n=n, full_info=full_info, seed=0,
+                                      compile_policies=True)
+                simulator.batch_set_trollies(build_population(population, n))
+                results.append(measure(
+                    f"run_trials/{population}/n={n}/full_info={full_info}",
+                    lambda: simulator.run_trials(num_trials), num_trials,
+                    n=n, population=population, full_info=full_info, **timing))
+    return results
+
+
+def bench_sharded(n_arr, num_workers, **timing):
+    """homo population on a ShardedSimulator, the mix has random agents"""
+    results = []
+    for n in n_arr:
+        num_trials = max(1, min(1000, CELL_BUDGET // n))
+        for full_info in [0, 1]:
+            with ShardedSimulator(n=n, full_info=full_info, seed=0,
+                                  num_workers=num_workers) as simulator:
+                simulator.batch_set_trollies(build_population("homo", n))
+                results.append(measure(
+                    f"sharded/workers={num_workers}/n={n}/full_info={full_info}",
+                    lambda: simulator.run_trials(num_trials), num_trials,
+                    n=n, population="homo", full_info=full_info,
+                    num_workers=num_workers, **timing))
+    return results
+
+
+def bench_mix_comp(n_arr, num_round=3, num_sim=100, **timing):
+    results = []
+    for n in n_arr:
+        for loss_type in [LossType.TELE, LossType.DEON]:
+            def run():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    mix_comp_cell(n, loss_type, num_round=num_round,
+                                  num_sim=num_sim, ratio=0.2)
+            results.append(measure(
+                f"mix_comp/n={n}/loss={loss_type.value}", run,
+                num_round * num_sim, n=n, population="mix_comp",
+                loss_type=loss_type.value, **timing))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    return: list of (name, baseline trials/sec, new trials/sec) of the cases
+            that are slower than the baseline by more than tolerance
+    """
+    baseline_tps = {result["name"]: result["trials_per_sec"]
+                    for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old_tps = baseline_tps.get(result["name"])
+        if old_tps is not None and result["trials_per_sec"] < old_tps * (1 - tolerance):
+            regressions.append((result["name"], old_tps, result["trials_per_sec"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="bench.json",
+                        help="path of the json result file")
+    parser.add_argument("--baseline", default=None,
+                        help="json result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown against the baseline")
+    parser.add_argument("--quick", action="store_true",
+                        help="only run a small subset of the n grid")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="also run the n>=1e4 cases on a ShardedSimulator "
+                             "with this many workers")
+    parser.add_argument("--repeats", type=int, default=REPEATS,
+                        help="timing repeats of every case, the best is kept")
+    parser.add_argument("--min-seconds", type=float, default=MIN_SECONDS,
+                        help="least time every timing repeat runs a case for")
+    args = parser.parse_args(argv)
+
+    timing = {"repeats": args.repeats, "min_seconds": args.min_seconds}
+    results = bench_run_trials(QUICK_N_ARR if args.quick else N_ARR, **timing)
+    if args.shards:
+        n_arr = QUICK_N_ARR if args.quick else N_ARR
+        results += bench_sharded([n for n in n_arr if n >= 10**4], args.shards,
+                                 **timing)
+    results += bench_mix_comp(COMP_N_ARR[:1] if args.quick else COMP_N_ARR,
+                              **timing)
+    report = {"meta": {"python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "machine": platform.machine(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"save benchmark results at={args.output}", file=sys.stderr)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old_tps, new_tps in regressions:
+            print(f"REGRESSION {name}: {old_tps:.1f} -> {new_tps:.1f} trials/sec",
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Content-addressed on-disk cache of experiment cell results
+"""
+import os, json, hashlib
+from checkpoint_utils import save_checkpoint, load_checkpoint
+
+
+def source_version(src_dir, exclude=()):
+    """
+    src_dir: directory of the source files the cached results depend on
+    exclude: file names that can't change a result (plotting, output ...)
+    return: hash of every .py file of src_dir except exclude
+    """
+    digest = hashlib.sha256()
+    for file_name in sorted(os.listdir(src_dir)):
+        if not file_name.endswith(".py") or file_name in exclude:
+            continue
+        digest.update(file_name.encode())
+        with open(os.path.join(src_dir, file_name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_key(definition):
+    """
+    definition: json serializable dict describing everything a result
+                depends on (experiment, parameters, seed, code version ...)
+    return: sha256 hex digest of the canonical json of the definition
+    """
+    canonical = json.dumps(definition, sort_keys=True, separators=(",", ":"),
+                           default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    results pickled one file per key, entries are evicted least recently
+    used first once the cache is larger than max_bytes
+    """
+    SUFFIX = ".pkl"
+
+    def __init__(self, cache_dir, max_bytes=2**28):
+        """
+        cache_dir: directory of the cache, created if missing
+        max_bytes: size bound of all the entries together
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.SUFFIX)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key, default=None):
+        """return: cached result of key, default if missing"""
+        path = self.path(key)
+        try:
+            result = load_checkpoint(path)
+        except (FileNotFoundError, EOFError):
+            return default
+        # the modification time is the last use, see evict
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        save_checkpoint(self.path(key), result)
+        self.evict()
+
+    def entries(self):
+        """return: list of (last use, size, key) of every entry"""
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(self.SUFFIX):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, file_name))
+            entries.append((stat.st_mtime, stat.st_size,
+                            file_name[:-len(self.SUFFIX)]))
+        return entries
+
+    def evict(self):
+        """delete the least recently used entries until within max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+
+    def invalidate(self, key=None):
+        """delete the entry of key, every entry if key is None"""
+        keys = [key] if key is not None else [key for _, _, key in self.entries()]
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,26 @@
+"""
+Utilities for checkpointing long simulation runs
+"""
+import os, pickle
+
+
+def save_checkpoint(path, state):
+    """
+    pickle state to path, the file is written next to path and renamed over
+    it so a run killed mid-write keeps its previous checkpoint
+    """
+    dir_name = os.path.dirname(path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """return: the state saved by save_checkpoint"""
+    with open(path, "rb") as f:
+        return pickle.load(f)
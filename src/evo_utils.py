@@ -0,0 +1,251 @@
+"""
+Batched evolutionary competition of trolly agent types
+
+Runs many independent replicates of the mix_comp_exp competition at once.
+The population of every replicate is an array of integer type codes (an
+index into the list of agent types), so the R replicates form one (R, n)
+simulation and selection, replacement and shuffling are array operations.
+"""
+import numpy as np
+from sim_utils import LossType, make_rng, ring_outcome, TRACK_MAX, PASS_MAX
+from stats_utils import AgentStats
+from agents_utils import CompiledAgent, MAX_TABLE_CELLS
+
+# number of trolly decisions simulated per chunk of trials
+CHUNK_CELLS = 2 * 10**6
+
+
+class EvolutionEngine:
+    def __init__(self, agent_cons_arr, n, num_replicates, full_info=1, seed=0,
+                 track_max=TRACK_MAX, pass_max=PASS_MAX):
+        """
+        agent_cons_arr: agent constructors, the type code of an agent is its
+                        index in this list
+        n: number of trollies in each replicate
+        num_replicates: number of independent replicates
+        full_info: wether or not trollies have full information
+        seed: random seed (int, SeedSequence or Generator)
+        track_max: maximum possible number of people tied on one track
+        pass_max: maximum possible number of passengers on a trolly
+        """
+        if n % len(agent_cons_arr) != 0:
+            raise ValueError(f"n={n} not a divisible by number of"
+                             f"agent types={len(agent_cons_arr)}")
+        self.n = n
+        self.num_replicates = num_replicates
+        self.full_info = full_info
+        self.track_max = track_max
+        self.pass_max = pass_max
+        # smallest signed integer type holding every draw, sums are int64
+        self.draw_dtype = np.min_scalar_type(-max(track_max, pass_max))
+
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        sim_seed, agent_seed = seed.spawn(2)
+        self.rng = make_rng(sim_seed)
+        # one agent per type decides for every trolly of that type
+        self.agents = [Cons(child_seed, pass_max=pass_max, track_max=track_max)
+                       for Cons, child_seed
+                       in zip(agent_cons_arr, agent_seed.spawn(len(agent_cons_arr)))]
+        self.agent_label_arr = [str(agent) for agent in self.agents]
+        self.num_types = len(self.agents)
+        # learning types learn separately in every replicate, with one
+        # table per replicate (see LearningAgent.set_num_replicates)
+        self.learning = any(agent.learning for agent in self.agents)
+        for agent in self.agents:
+            if agent.learning:
+                agent.set_num_replicates(num_replicates)
+        # decisions of every deterministic type stacked into one lookup
+        # table indexed by [type code, agent inputs...], rows of the other
+        # types are left at 0 and decided with decide_batch, as every type is
+        # if the stacked table would exceed MAX_TABLE_CELLS
+        shape = CompiledAgent.table_shape(pass_max, track_max, full_info)
+        self.tabulated = [agent.deterministic for agent in self.agents]
+        if self.num_types * np.prod(shape) > MAX_TABLE_CELLS:
+            self.tabulated = [False] * self.num_types
+        self.policy_table = np.stack([
+            CompiledAgent(agent).table(full_info) if tabulated
+            else np.zeros(shape, dtype=np.uint8)
+            for agent, tabulated in zip(self.agents, self.tabulated)]) \
+            if any(self.tabulated) else None
+
+    def init_population(self):
+        """balanced type codes, shuffled independently in every replicate"""
+        codes = np.tile(np.arange(self.num_types, dtype=np.int8),
+                        (self.num_replicates, self.n // self.num_types))
+        return self.shuffle(codes)
+
+    def shuffle_order(self):
+        """return: (R, n) independent permutation of every replicate"""
+        return np.argsort(self.rng.random((self.num_replicates, self.n)), axis=1)
+
+    def shuffle(self, arr):
+        """independent permutation of every row"""
+        return np.take_along_axis(arr, self.shuffle_order(), axis=1)
+
+    def count_types(self, codes):
+        """return: (R, #types) number of agents of each type per replicate"""
+        offset = np.arange(self.num_replicates)[:, None] * self.num_types
+        return np.bincount((codes + offset).ravel(),
+                           minlength=self.num_replicates*self.num_types) \
+            .reshape(self.num_replicates, self.num_types)
+
+    def decide(self, codes, track_nums, pass_nums):
+        """
+        codes: (R, n) type code of each trolly
+        track_nums, pass_nums: (R, k, n) draws of k trials per replicate
+        return: (R, k, n) decisions, a single table lookup for every
+                tabulated type and one decide_batch call for each other
+        """
+        alt_track_nums = np.roll(track_nums, -1, axis=-1)
+        cell_codes = codes[:, None, :]
+        if self.full_info:
+            neigh_pass_nums = (np.roll(pass_nums, 1, axis=-1),
+                               np.roll(pass_nums, -1, axis=-1))
+        else:
+            neigh_pass_nums = ()
+        if self.policy_table is None:
+            decisions = np.zeros(track_nums.shape, dtype=np.uint8)
+        else:
+            decisions = self.policy_table[(cell_codes, pass_nums, track_nums,
+                                           alt_track_nums) + neigh_pass_nums]
+        inputs = (pass_nums, track_nums, alt_track_nums) + neigh_pass_nums
+        for code, agent in enumerate(self.agents):
+            if self.tabulated[code]:
+                continue
+            idx = self.type_entries(codes, track_nums.shape, code)
+            if len(idx) == 0:
+                continue
+            kwargs = {"replicate_idx": idx // track_nums[0].size} \
+                if agent.learning else {}
+            decisions.reshape(-1)[idx] = agent.decide_batch(
+                *[arr.reshape(-1).take(idx) for arr in inputs], **kwargs)
+        return decisions
+
+    def simulate(self, codes, num_sim, records):
+        """
+        run num_sim trials in every replicate and add the per-slot kills and
+        encounters to records (stats_utils.AgentStats of (R, n) slots)
+        """
+        chunk = max(1, CHUNK_CELLS // (self.num_replicates * self.n))
+        done = 0
+        while done < num_sim:
+            k = min(chunk, num_sim - done)
+            shape = (self.num_replicates, k, self.n)
+            track_nums = self.rng.integers(0, self.track_max+1, size=shape,
+                                           dtype=self.draw_dtype)
+            pass_nums = self.rng.integers(0, self.pass_max+1, size=shape,
+                                          dtype=self.draw_dtype)
+            decisions = self.decide(codes, track_nums, pass_nums)
+            pass_kills, track_kills, _ = ring_outcome(track_nums, pass_nums,
+                                                      decisions)
+            if self.learning:
+                self.learn(codes, track_nums, pass_nums, decisions, pass_kills,
+                           track_kills)
+            track_tot = track_nums.sum(axis=1)
+            records.add(np.stack([pass_kills.sum(axis=1), track_kills.sum(axis=1),
+                                  pass_nums.sum(axis=1),
+                                  track_tot + np.roll(track_tot, -1, axis=-1)]))
+            done += k
+
+    def learn(self, codes, track_nums, pass_nums, decisions, pass_kills,
+              track_kills):
+        """
+        let every learning type update the policy of each replicate on the
+        outcome of a chunk of trials, with one update_batch call per type,
+        arguments are (R, k, n) like decide
+        """
+        alt_track_nums = np.roll(track_nums, -1, axis=-1)
+        if self.full_info:
+            neigh_pass_nums = (np.roll(pass_nums, 1, axis=-1),
+                               np.roll(pass_nums, -1, axis=-1))
+        else:
+            neigh_pass_nums = (None, None)
+        arrs = (pass_nums, track_nums, alt_track_nums) + neigh_pass_nums \
+            + (decisions, pass_kills, track_kills)
+        for code, agent in enumerate(self.agents):
+            if not agent.learning:
+                continue
+            idx = self.type_entries(codes, track_nums.shape, code)
+            if len(idx) == 0:
+                continue
+            agent.update_batch(*[arr if arr is None else arr.reshape(-1).take(idx)
+                                 for arr in arrs],
+                               replicate_idx=idx // track_nums[0].size)
+
+    @staticmethod
+    def type_entries(codes, shape, code):
+        """
+        return: flat indices of the entries of a type in (R, k, n) arrays,
+                the replicate of an entry is its index // (k*n)
+        """
+        return np.flatnonzero(np.broadcast_to(codes[:, None, :], shape) == code)
+
+    def select(self, records, num_select, loss_type):
+        """
+        return: (top, bot) (R, num_select) slot indices of the lowest and
+                highest losses of every replicate, slots without encounters
+                are picked last on both ends (see get_top_bot_n_trolly_idx)
+        """
+        if loss_type == LossType.TELE:
+            kills = records["pass_kills"] + records["track_kills"]
+            ecounter = records["pass_tot"] + records["track_tot"]
+        elif loss_type == LossType.DEON:
+            kills = records["pass_kills"]
+            ecounter = records["pass_tot"]
+        else:
+            raise TypeError('loss type must be an instance of LossType')
+        losses = np.full(kills.shape, np.nan)
+        np.divide(kills, ecounter, out=losses, where=ecounter > 0)
+
+        top_key = np.where(np.isnan(losses), np.inf, losses)
+        top = np.argpartition(top_key, num_select-1, axis=1)[:, :num_select]
+        bot_key = np.where(np.isnan(losses), np.inf, -losses)
+        bot = np.argpartition(bot_key, num_select-1, axis=1)[:, :num_select]
+        return top, bot
+
+    def run(self, loss_type, num_round=10, num_sim=100, ratio=0.1,
+            agent_stats=False, window=None, decay=None):
+        """
+        batched version of one loss type of mix_comp_exp: every round runs
+        num_sim trials, the max(1, ratio*n) best agents of each replicate
+        replace its worst ones and the ring is reshuffled. like the
+        Simulator, kills and encounters stay with the slot and accumulate
+        over the rounds
+        agent_stats: rank the agents by their own kills and encounters
+                     instead, they move with the agent on shuffle and start
+                     over for a new agent (see Simulator.enable_agent_stats)
+        window, decay: with agent_stats, only count the last window rounds or
+                       decay the past rounds, see stats_utils.AgentStats
+        return: dict of
+            labels - agent type labels
+            counts - (R, num_round+1, #types) agent counts per round
+            mean, std - (num_round+1, #types) spread across replicates
+        """
+        if not isinstance(loss_type, LossType):
+            raise TypeError('loss type must be an instance of LossType')
+        num_select = max(1, int(ratio*self.n))
+        if not agent_stats and (window is not None or decay is not None):
+            raise ValueError("window and decay need agent_stats")
+        codes = self.init_population()
+        records = AgentStats((self.num_replicates, self.n), window=window,
+                             decay=decay)
+        counts = np.zeros((self.num_replicates, num_round+1, self.num_types),
+                          dtype=np.int64)
+        counts[:, 0] = self.count_types(codes)
+        for i_round in range(1, num_round+1):
+            self.simulate(codes, num_sim, records)
+            rep_idx, eli_idx = self.select(records, num_select, loss_type)
+            np.put_along_axis(codes, eli_idx,
+                              np.take_along_axis(codes, rep_idx, axis=1), axis=1)
+            order = self.shuffle_order()
+            codes = np.take_along_axis(codes, order, axis=1)
+            if agent_stats:
+                replaced = np.zeros(codes.shape, dtype=bool)
+                np.put_along_axis(replaced, eli_idx, True, axis=1)
+                records.reset(replaced)
+                records.advance()
+                records.permute(order)
+            counts[:, i_round] = self.count_types(codes)
+        return {"labels": self.agent_label_arr, "counts": counts,
+                "mean": counts.mean(axis=0), "std": counts.std(axis=0)}
@@ -0,0 +1,68 @@
+"""
+Utilities for instrumenting the simulator hot path
+"""
+import time
+from collections import defaultdict
+
+
+class Instrumentation:
+    """
+    per-phase timers and event counters of a Simulator, enable it with
+    Simulator.enable_instrumentation()
+    phases: draw - drawing track and passenger numbers
+            decide - agent decisions
+            collide - collision resolution
+            account - accumulator updates
+            stats - streaming loss statistics
+    counters: trials, draws, collisions (shared tracks), decisions:<agent>
+    """
+    PHASES = ["draw", "decide", "collide", "account", "stats"]
+
+    def __init__(self):
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """
+        hook: function called as hook(event, value) for every timed phase
+              (event=phase name, value=seconds) and every counter update
+              (event=counter name, value=increment)
+        """
+        self.hooks.append(hook)
+
+    def lap(self, phase, start):
+        """
+        charge the time since start to phase
+        return: current time, the start of the next phase
+        """
+        now = time.perf_counter()
+        self.timers[phase] += now - start
+        for hook in self.hooks:
+            hook(phase, now - start)
+        return now
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+        for hook in self.hooks:
+            hook(counter, value)
+
+    def clear(self):
+        self.timers.clear()
+        self.counters.clear()
+
+    def report(self):
+        """summary of the timers and counters as printable text"""
+        total = sum(self.timers.values())
+        lines = [f"instrumentation: {total:.3f}s in timed phases"]
+        for phase in self.PHASES + sorted(set(self.timers) - set(self.PHASES)):
+            if phase in self.timers:
+                seconds = self.timers[phase]
+                share = seconds / total if total else 0.0
+                lines.append(f"  {phase:<10} {seconds:9.4f}s {share:6.1%}")
+        for counter in sorted(self.counters):
+            lines.append(f"  {counter:<30} {self.counters[counter]}")
+        trials = self.counters.get("trials", 0)
+        if trials and total:
+            lines.append(f"  {trials/total:.1f} trials/sec")
+        return "\n".join(lines)
@@ -1,221 +1,580 @@
-import os, random
-import matplotlib.pyplot as plt
+import os, sys, argparse
 import numpy as np
 from agents_utils import RandomAgent, AlwaysDoNothingAgent, AlwaysSwitchAgent,\
                          TrackLifeAgent, StatAgent
-from sim_utils import Simulator, LossType
+from sim_utils import Simulator, LossType, make_rng, TRACK_MAX, PASS_MAX
+from analytic_utils import expected_losses
+from sweep_utils import make_cell, run_sweep
+from evo_utils import EvolutionEngine
+from trace_utils import TraceRecorder
+from cache_utils import ResultCache, cache_key, source_version
+from scenario_utils import ScenarioBank
+from stats_utils import paired_difference
+from result_utils import save_results
+
+
+AGENT_CONS_ARR = [RandomAgent, AlwaysDoNothingAgent,
+                  AlwaysSwitchAgent, TrackLifeAgent, StatAgent]
+AGENT_LABEL_ARR = [str(Cons(0)) for Cons in AGENT_CONS_ARR]
+# source files that can't change a cell result, every other file of src/
+# (this one included) is hashed into the cache keys, see cell_definition
+NON_RESULT_SOURCES = ["plot_utils.py", "result_utils.py", "benchmark.py"]
+# cell parameters that don't change the result of a cell
+NON_RESULT_PARAMS = ["instrument", "trace_dir", "checkpoint_path",
+                     "checkpoint_every"]
+# default directory of the plots of the *_exp functions and sweep
+PLOT_DIR = os.path.join("..", "plots")
+
+
+def cell_seeds(seed):
+    """
+    split the seed of a cell into independent streams for the simulator,
+    the agents and the population shuffle, so every cell runs the same alone
+    or in a sweep
+    return: (simulator seed, agent SeedSequence, shuffle Generator)
+    """
+    sim_seed, agent_seed_seq, shuffle_seed = \
+        np.random.SeedSequence(seed).spawn(3)
+    return sim_seed, agent_seed_seq, make_rng(shuffle_seed)
 
 
-def homo_exp(n):
-    full_info_losses = {"tele": [], "deon": []}
-    part_info_losses = {"tele": [], "deon": []}
-    loss_dicts = [part_info_losses, full_info_losses]
-    agent_cons_arr = [RandomAgent, AlwaysDoNothingAgent,
-                      AlwaysSwitchAgent, TrackLifeAgent, StatAgent]
-    agent_label_arr = [str(Cons(0)) for Cons in agent_cons_arr]
+def new_agent(Cons, agent_seed_seq):
+    """construct an agent with its own child stream of agent_seed_seq"""
+    return Cons(agent_seed_seq.spawn(1)[0])
 
-    for full_info in [0, 1]:
-        print(f"start homogenous experiments, full_info={full_info}, n={n}")
-        simulator = Simulator(n=n, full_info=full_info, seed=0)
-
-        for Cons in agent_cons_arr:
-            agent_arr = [Cons(0) for i in range(n)]
-            simulator.batch_set_trollies(agent_arr)
-            for i in range(1000):
-                simulator.refresh_track_nums()
-                simulator.refresh_pass_nums()
-                simulator.run_trial()
 
+def homo_cell(n, full_info, seed=0, exact=False, num_trials=1000,
+              ci_halfwidth=None, instrument=False, trace_dir=None):
+    """
+    one information mode of the homogenous experiment
+    exact: compute the exact expected losses instead of running trials
+    num_trials: number of trials (maximum number with ci_halfwidth)
+    ci_halfwidth: stop early once the 95% confidence intervals are this narrow
+    instrument: print a timing and counter summary of the simulator at the end
+    trace_dir: record the trials of each agent type to a trace in
+               trace_dir/<agent label>, see trace_utils
+    return: {"tele": [...], "deon": [...], "tele_ci": [...], "deon_ci": [...]}
+            losses and confidence interval half widths of each agent type
+    """
+    sim_seed, agent_seed_seq, _ = cell_seeds(seed)
+    losses = {"tele": [], "deon": [], "tele_ci": [], "deon_ci": []}
+    print(f"start homogenous experiments, full_info={full_info}, n={n}")
+    simulator = Simulator(n=n, full_info=full_info, seed=sim_seed,
+                          compile_policies=True)
+    if instrument:
+        simulator.enable_instrumentation()
+
+    for Cons in AGENT_CONS_ARR:
+        agent_arr = [new_agent(Cons, agent_seed_seq) for i in range(n)]
+        simulator.batch_set_trollies(agent_arr)
+        if exact:
+            exact_losses = expected_losses(simulator)
+            tele_loss = exact_losses["tele"]
+            deon_loss = exact_losses["deon"]
+            halfwidths = {"tele": 0.0, "deon": 0.0}
+        else:
+            if trace_dir is not None:
+                simulator.enable_trace(TraceRecorder(
+                    os.path.join(trace_dir, str(agent_arr[0])), n,
+                    meta={"exp": "homo", "full_info": full_info,
+                          "agent": str(agent_arr[0])}))
+            if ci_halfwidth is None:
+                simulator.run_trials(num_trials)
+            else:
+                simulator.run_until(ci_halfwidth, max_trials=num_trials)
+            simulator.disable_trace()
             tele_loss = simulator.get_tot_tele_loss()
             deon_loss = simulator.get_tot_deon_loss()
-            print(f"{agent_arr[0]}: tele_loss={tele_loss:.3f},"
-                  f"deon_loss={deon_loss:.3f}")
-            loss_dicts[full_info]['tele'].append(tele_loss)
-            loss_dicts[full_info]['deon'].append(deon_loss)
-            simulator.clear_records()
-        print()
+            halfwidths = simulator.get_ci_halfwidths()
+        print(f"{agent_arr[0]}: tele_loss={tele_loss:.3f},"
+              f"deon_loss={deon_loss:.3f}, #trials={simulator.total_trials}")
+        losses['tele'].append(tele_loss)
+        losses['deon'].append(deon_loss)
+        losses['tele_ci'].append(halfwidths["tele"])
+        losses['deon_ci'].append(halfwidths["deon"])
+        simulator.clear_records()
+    if instrument:
+        print(simulator.instrument.report())
+    print()
+    return losses
+
+
+def homo_exp(n, seed=0, exact=False, num_trials=1000, ci_halfwidth=None,
+             instrument=False, plot_dir=PLOT_DIR):
+    """
+    plot_dir: directory of the plot, None to skip plotting
+    return: loss dicts of full_info 0 and 1, see homo_cell
+    """
+    loss_dicts = [homo_cell(n, full_info, seed, exact, num_trials, ci_halfwidth,
+                            instrument) for full_info in [0, 1]]
+    if plot_dir is not None:
+        plot_homo_exp(n, loss_dicts, plot_dir)
+    return loss_dicts
 
-    plot_dir = "../plots"
-    if not os.path.exists(plot_dir):
-        os.makedirs(plot_dir)
-    plot_url = os.path.join(plot_dir, f"homo_exp_loss_plot_n={n}.png")
-    title = f"homogenous experiment loss plot n={n}"
-    plot_losses(plot_url, title, loss_dicts, agent_label_arr)
 
+def plot_homo_exp(n, loss_dicts, plot_dir=PLOT_DIR):
+    from plot_utils import plot_path, plot_losses
+    plot_url = plot_path(plot_dir, f"homo_exp_loss_plot_n={n}.png")
+    title = f"homogenous experiment loss plot n={n}"
+    plot_losses(plot_url, title, loss_dicts, AGENT_LABEL_ARR)
 
-def mix_exp(n):
-    full_info_losses = {"tele": [], "deon": []}
-    part_info_losses = {"tele": [], "deon": []}
-    loss_dicts = [part_info_losses, full_info_losses]
 
-    agent_cons_arr = [RandomAgent, AlwaysDoNothingAgent,
-                      AlwaysSwitchAgent, TrackLifeAgent, StatAgent]
-    agent_label_arr = [str(Cons(0)) for Cons in agent_cons_arr]
-    if n % len(agent_label_arr) != 0:
+def homo_crn_cell(n, bank_path, seed=0):
+    """
+    homogenous experiment with common random numbers, every agent type in
+    both information modes runs the same scenarios of the bank
+    bank_path: directory of a ScenarioBank for n trollies
+    return: {"losses": loss dicts of full_info 0 and 1 (see homo_cell),
+             "paired": list of paired differences of the mean per-trial
+             losses between every 2 agent types in each information mode
+             and between the 2 modes of every agent type}
+    """
+    sim_seed, agent_seed_seq, _ = cell_seeds(seed)
+    bank = ScenarioBank(bank_path)
+    print(f"start homogenous CRN experiments, n={n} #scenarios={len(bank)}")
+    loss_dicts = []
+    samples = {}
+    for full_info in [0, 1]:
+        losses = {"tele": [], "deon": [], "tele_ci": [], "deon_ci": []}
+        for Cons, label in zip(AGENT_CONS_ARR, AGENT_LABEL_ARR):
+            simulator = Simulator(n=n, full_info=full_info, seed=sim_seed,
+                                  compile_policies=True)
+            simulator.batch_set_trollies([new_agent(Cons, agent_seed_seq)
+                                          for i in range(n)])
+            samples[full_info, label] = simulator.run_scenarios(bank)
+            halfwidths = simulator.get_ci_halfwidths()
+            losses['tele'].append(simulator.get_tot_tele_loss())
+            losses['deon'].append(simulator.get_tot_deon_loss())
+            losses['tele_ci'].append(halfwidths["tele"])
+            losses['deon_ci'].append(halfwidths["deon"])
+        loss_dicts.append(losses)
+
+    pairs = [((full_info, label_a), (full_info, label_b)) for full_info in [0, 1]
+             for i, label_a in enumerate(AGENT_LABEL_ARR)
+             for label_b in AGENT_LABEL_ARR[i+1:]]
+    pairs += [((1, label), (0, label)) for label in AGENT_LABEL_ARR]
+    paired = []
+    for key_a, key_b in pairs:
+        for loss_key in ["tele", "deon"]:
+            diff = paired_difference(samples[key_a][loss_key],
+                                     samples[key_b][loss_key])
+            paired.append({"loss": loss_key,
+                           "a": f"{key_a[1]}(full_info={key_a[0]})",
+                           "b": f"{key_b[1]}(full_info={key_b[0]})", **diff})
+            print(f"{loss_key}: {paired[-1]['a']} - {paired[-1]['b']} = "
+                  f"{diff['mean']:.4f} +/- {diff['ci_halfwidth']:.4f} "
+                  f"(unpaired +/- {diff['unpaired_ci_halfwidth']:.4f})")
+    print()
+    return {"losses": loss_dicts, "paired": paired}
+
+
+def homo_crn_exp(n, num_trials=1000, seed=0, bank_dir=os.path.join("..", "banks"),
+                 plot_dir=PLOT_DIR):
+    """
+    homo_exp on a shared scenario bank, the bank is drawn once per
+    (n, num_trials, seed) in bank_dir and reused by later runs
+    plot_dir: directory of the plot, None to skip plotting
+    """
+    bank = ScenarioBank.create(
+        os.path.join(bank_dir, f"bank_n={n}_#trials={num_trials}_seed={seed}"),
+        n, num_trials, seed=seed)
+    result = homo_crn_cell(n, bank.path, seed)
+    if plot_dir is not None:
+        from plot_utils import plot_path, plot_losses
+        plot_url = plot_path(plot_dir, f"homo_crn_exp_loss_plot_n={n}.png")
+        title = f"homogenous CRN experiment loss plot n={n} #scenarios={num_trials}"
+        plot_losses(plot_url, title, result["losses"], AGENT_LABEL_ARR)
+    return result
+
+
+def mix_cell(n, full_info, seed=0, exact=False, num_trials=1000,
+             ci_halfwidth=None, instrument=False, trace_dir=None):
+    """
+    one information mode of the mixed experiment
+    exact: compute the exact expected losses instead of running trials
+    num_trials: number of trials (maximum number with ci_halfwidth)
+    ci_halfwidth: stop early once the 95% confidence intervals of every
+                  agent type are this narrow
+    instrument: print a timing and counter summary of the simulator at the end
+    trace_dir: record every trial to a trace in this directory, see
+               trace_utils
+    return: {"tele": [...], "deon": [...], "tele_ci": [...], "deon_ci": [...]}
+            losses and confidence interval half widths of each agent type
+    """
+    if n % len(AGENT_LABEL_ARR) != 0:
         raise ValueError(f"n={n} not a divisible by number of"
-                         f"agent types={len(agent_label_arr)}")
+                         f"agent types={len(AGENT_LABEL_ARR)}")
+    sim_seed, agent_seed_seq, shuffle_rng = cell_seeds(seed)
+    losses = {"tele": [], "deon": [], "tele_ci": [], "deon_ci": []}
     agent_arr = []
-    for i in range(n//len(agent_cons_arr)):
-        for Cons in agent_cons_arr:
-            agent_arr.append(Cons(0))
-    random.shuffle(agent_arr)
-    agent_str_arr = [str(agent) for agent in agent_arr]
+    for i in range(n//len(AGENT_CONS_ARR)):
+        for Cons in AGENT_CONS_ARR:
+            agent_arr.append(new_agent(Cons, agent_seed_seq))
+    agent_arr = [agent_arr[i] for i in shuffle_rng.permutation(n)]
+    agent_str_arr = np.array([str(agent) for agent in agent_arr])
     assert len(agent_arr) == len(agent_str_arr) == n
 
-    for full_info in [0, 1]:
-        print(f"start mixed experiments, full_info={full_info} n={n}")
-        simulator = Simulator(n=n, full_info=full_info, seed=0)
-        simulator.batch_set_trollies(agent_arr)
-        for i in range(1000):
-            simulator.refresh_track_nums()
-            simulator.refresh_pass_nums()
-            simulator.run_trial()
-
-        for label in agent_label_arr:
-            indices = [i for i, x in enumerate(agent_str_arr) if x == label]
-            tele_loss = simulator.get_tele_loss_by_idx(indices)
-            deon_loss = simulator.get_deon_loss_by_idx(indices)
-            print(f"{label}: tele_loss={tele_loss:.3f}, deon_loss={deon_loss:.3f}")
-            loss_dicts[full_info]['tele'].append(tele_loss)
-            loss_dicts[full_info]['deon'].append(deon_loss)
-        print()
+    print(f"start mixed experiments, full_info={full_info} n={n}")
+    simulator = Simulator(n=n, full_info=full_info, seed=sim_seed,
+                          compile_policies=True)
+    if instrument:
+        simulator.enable_instrumentation()
+    simulator.batch_set_trollies(agent_arr)
+    if not exact:
+        if trace_dir is not None:
+            simulator.enable_trace(TraceRecorder(
+                trace_dir, n, meta={"exp": "mix", "full_info": full_info}))
+        if ci_halfwidth is None:
+            simulator.run_trials(num_trials)
+        else:
+            simulator.run_until(ci_halfwidth, max_trials=num_trials,
+                                by_type=True)
+        simulator.disable_trace()
+        type_halfwidths = simulator.get_ci_halfwidths(by_type=True)["types"]
+
+    for label in AGENT_LABEL_ARR:
+        mask = agent_str_arr == label
+        if exact:
+            exact_losses = expected_losses(simulator, mask)
+            tele_loss = exact_losses["tele"]
+            deon_loss = exact_losses["deon"]
+            halfwidths = {"tele": 0.0, "deon": 0.0}
+        else:
+            tele_loss = simulator.get_tele_loss_by_idx(mask)
+            deon_loss = simulator.get_deon_loss_by_idx(mask)
+            # types without samples (e.g. after 0 trials) have no stats
+            halfwidths = type_halfwidths.get(label, {"tele": float("nan"),
+                                                     "deon": float("nan")})
+        print(f"{label}: tele_loss={tele_loss:.3f}, deon_loss={deon_loss:.3f}")
+        losses['tele'].append(tele_loss)
+        losses['deon'].append(deon_loss)
+        losses['tele_ci'].append(halfwidths["tele"])
+        losses['deon_ci'].append(halfwidths["deon"])
+    if instrument:
+        print(simulator.instrument.report())
+    print()
+    return losses
+
+
+def mix_exp(n, seed=0, exact=False, num_trials=1000, ci_halfwidth=None,
+            instrument=False, plot_dir=PLOT_DIR):
+    """
+    plot_dir: directory of the plot, None to skip plotting
+    return: loss dicts of full_info 0 and 1, see mix_cell
+    """
+    loss_dicts = [mix_cell(n, full_info, seed, exact, num_trials, ci_halfwidth,
+                           instrument) for full_info in [0, 1]]
+    if plot_dir is not None:
+        plot_mix_exp(n, loss_dicts, plot_dir)
+    return loss_dicts
 
-    plot_dir = "../plots"
-    if not os.path.exists(plot_dir):
-        os.makedirs(plot_dir)
-    plot_url = os.path.join(plot_dir, f"mix_exp_loss_plot_n={n}.png")
+
+def plot_mix_exp(n, loss_dicts, plot_dir=PLOT_DIR):
+    from plot_utils import plot_path, plot_losses
+    plot_url = plot_path(plot_dir, f"mix_exp_loss_plot_n={n}.png")
     title = f"mixed experiment loss plot n={n}"
-    plot_losses(plot_url, title, loss_dicts, agent_label_arr)
+    plot_losses(plot_url, title, loss_dicts, AGENT_LABEL_ARR)
 
 
-def mix_comp_exp(n, num_round=10, num_sim=100, ratio=0.1):
+def mix_comp_cell(n, loss_type, num_round=10, num_sim=100, ratio=0.1, seed=0,
+                  instrument=False, checkpoint_path=None, checkpoint_every=1,
+                  agent_stats=False, window=None, decay=None):
     """
-    n: number of trollies in the experiment
-    num_round: number of rounds to compete
-    num_sim: number of simulations in each round
-    ratio: top/bottom percentage to repopulate and eliminate
+    one loss type of the mixed competition experiment
+    instrument: print a timing and counter summary of the simulator at the end
+    agent_stats: rank the agents by their own kills and encounters instead
+                 of their slot's, see Simulator.enable_agent_stats
+    window, decay: with agent_stats, only count the last window rounds or
+                   decay the past rounds by this factor per round
+    checkpoint_path: save the run to this file every checkpoint_every rounds
+                     and resume from it if it exists, a resumed run gives
+                     the same result as an uninterrupted one, the file is
+                     deleted once the cell finishes
+    return: list of {agent label: count} for each round
     """
-    agent_cons_arr = [RandomAgent, AlwaysDoNothingAgent,
-                      AlwaysSwitchAgent, TrackLifeAgent, StatAgent]
-    agent_label_arr = [str(Cons(0)) for Cons in agent_cons_arr]
-    if n % len(agent_label_arr) != 0:
+    if n % len(AGENT_LABEL_ARR) != 0:
         raise ValueError(f"n={n} not a divisible by number of"
-                         f"agent types={len(agent_label_arr)}")
-
-    # data structure that stores agent counts by type in each round
-    agent_type_count_dict = {
-        LossType.TELE.value: [{label: 0 for label in agent_label_arr}
-                                for i in range(num_round+1)],
-        LossType.DEON.value: [{label: 0 for label in agent_label_arr}
-                                for i in range(num_round+1)]}
-
-    for loss_type in [LossType.TELE, LossType.DEON]:
-        agent_type_count = agent_type_count_dict[loss_type.value]
+                         f"agent types={len(AGENT_LABEL_ARR)}")
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        simulator, state = Simulator.restore(checkpoint_path)
+        agent_seed_seq = state["agent_seed_seq"]
+        agent_type_count = state["agent_type_count"]
+        start_round = state["i_round"] + 1
+        print(f"resume from round {start_round} checkpoint={checkpoint_path}")
+    else:
+        sim_seed, agent_seed_seq, shuffle_rng = cell_seeds(seed)
+        # data structure that stores agent counts by type in each round
+        agent_type_count = [{label: 0 for label in AGENT_LABEL_ARR}
+                            for i in range(num_round+1)]
         # initialize agents (all balanced amount)
         agent_arr = []
-        for _ in range(n//len(agent_cons_arr)):
-            for Cons in agent_cons_arr:
-                agent_arr.append(Cons(0))
+        for _ in range(n//len(AGENT_CONS_ARR)):
+            for Cons in AGENT_CONS_ARR:
+                agent_arr.append(new_agent(Cons, agent_seed_seq))
                 # increment agent count
                 agent_type_count[0][str(agent_arr[-1])] += 1
-        random.shuffle(agent_arr)
+        agent_arr = [agent_arr[i] for i in shuffle_rng.permutation(n)]
 
         full_info = 1  # fixed full_info
-        simulator = Simulator(n=n, full_info=full_info, seed=0)
+        simulator = Simulator(n=n, full_info=full_info, seed=sim_seed,
+                              compile_policies=True)
+        if agent_stats:
+            simulator.enable_agent_stats(window=window, decay=decay)
         simulator.batch_set_trollies(agent_arr)
-        for i_round in range(1, num_round+1):
-            print(f"start round {i_round} loss type={loss_type.value}")
-            # perform 100 simulations
-            for i_sim in range(100):
-                simulator.refresh_track_nums()
-                simulator.refresh_pass_nums()
-                simulator.run_trial()
-            
-            # eliminate and repopulate max(1, top/bot 10%)
-            rep_idx_arr, eli_idx_arr = \
-                simulator.get_top_bot_n_trolly_idx(n=max(1, int(ratio*n)),
-                                                   loss_type=loss_type)
-
-            assert len(rep_idx_arr) == len(eli_idx_arr)
-            for i_rep in range(len(rep_idx_arr)):
-                rep_idx = rep_idx_arr[i_rep]
-                eli_idx = eli_idx_arr[i_rep]
-                label_idx = agent_label_arr.index(
-                    simulator.get_trolly_str_by_idx(rep_idx))
-                RepCons = agent_cons_arr[label_idx]
-                simulator.set_trolly_by_idx(eli_idx, RepCons(0))
-            simulator.shuffle_trolly_arr()
-            agent_str_arr = simulator.get_trolly_str_arr()
-            for label in agent_label_arr:
-                agent_type_count[i_round][label] += agent_str_arr.count(label)
-                print(f"number of {label} = {agent_str_arr.count(label)}",
-                      end="\t")
-            print()
-
-    plot_url = os.path.join("..", "plots", f"mix_comp_agent_count_plot_n={n}_"
-                            f"#rounds={num_round}_"f"#sim={num_sim}_"
-                            f"ratio={ratio}.png")
+        start_round = 1
+    if instrument:
+        simulator.enable_instrumentation()
+    for i_round in range(start_round, num_round+1):
+        print(f"start round {i_round} loss type={loss_type.value}")
+        # perform num_sim simulations
+        simulator.run_trials(num_sim)
+
+        # eliminate and repopulate max(1, top/bot 10%)
+        rep_idx_arr, eli_idx_arr = \
+            simulator.get_top_bot_n_trolly_idx(n=max(1, int(ratio*n)),
+                                               loss_type=loss_type)
+
+        assert len(rep_idx_arr) == len(eli_idx_arr)
+        for i_rep in range(len(rep_idx_arr)):
+            rep_idx = rep_idx_arr[i_rep]
+            eli_idx = eli_idx_arr[i_rep]
+            label_idx = AGENT_LABEL_ARR.index(
+                simulator.get_trolly_str_by_idx(rep_idx))
+            RepCons = AGENT_CONS_ARR[label_idx]
+            simulator.set_trolly_by_idx(eli_idx,
+                                        new_agent(RepCons, agent_seed_seq))
+        simulator.shuffle_trolly_arr()
+        simulator.advance_agent_stats()
+        agent_str_arr = simulator.get_trolly_str_arr()
+        for label in AGENT_LABEL_ARR:
+            agent_type_count[i_round][label] += agent_str_arr.count(label)
+            print(f"number of {label} = {agent_str_arr.count(label)}",
+                  end="\t")
+        print()
+        if checkpoint_path is not None and i_round % checkpoint_every == 0 \
+                and i_round < num_round:
+            simulator.checkpoint(checkpoint_path, agent_seed_seq=agent_seed_seq,
+                                 agent_type_count=agent_type_count,
+                                 i_round=i_round)
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        # a finished cell is never resumed, its result is in the cache
+        os.remove(checkpoint_path)
+    if instrument:
+        print(simulator.instrument.report())
+    return agent_type_count
+
+
+def mix_comp_exp(n, num_round=10, num_sim=100, ratio=0.1, seed=0,
+                 instrument=False, checkpoint_dir=None, plot_dir=PLOT_DIR,
+                 **selection):
+    """
+    n: number of trollies in the experiment
+    num_round: number of rounds to compete
+    num_sim: number of simulations in each round
+    ratio: top/bottom percentage to repopulate and eliminate
+    checkpoint_dir: checkpoint every loss type in this directory, see
+                    mix_comp_cell
+    plot_dir: directory of the plot, None to skip plotting
+    selection: agent_stats, window, decay of mix_comp_cell
+    return: {loss type: list of {agent label: count} for each round}
+    """
+    agent_type_count_dict = {}
+    for loss_type in [LossType.TELE, LossType.DEON]:
+        cell = make_cell("mix_comp", n, loss_type.value, num_round=num_round,
+                         num_sim=num_sim, ratio=ratio, seed=seed, **selection)
+        agent_type_count_dict[loss_type.value] = mix_comp_cell(
+            n, loss_type, num_round, num_sim, ratio, seed, instrument,
+            **mix_comp_checkpoint(checkpoint_dir, cell), **selection)
+    if plot_dir is not None:
+        plot_mix_comp_exp(n, num_round, num_sim, ratio, agent_type_count_dict,
+                          plot_dir)
+    return agent_type_count_dict
+
+
+def mix_comp_checkpoint(checkpoint_dir, cell):
+    """
+    return: checkpoint_path argument of a mix_comp cell, {} if no directory,
+            the file is named by the cache key of the cell so it is never
+            resumed by another cell or code version
+    """
+    if checkpoint_dir is None:
+        return {}
+    key = cache_key(cell_definition(cell))
+    return {"checkpoint_path": os.path.join(
+        checkpoint_dir, f"mix_comp_n={cell.n}_loss={cell.mode}_{key[:16]}.pkl")}
+
+
+def selection_kwargs(agent_stats=False, window=None, decay=None):
+    """
+    return: the agent_stats, window, decay arguments of the mix_comp cells,
+            {} for the default per-slot selection so its cells keep their
+            parameters
+    """
+    if not agent_stats:
+        if window is not None or decay is not None:
+            raise ValueError("window and decay need agent_stats")
+        return {}
+    return {"agent_stats": True, "window": window, "decay": decay}
+
+
+def plot_mix_comp_exp(n, num_round, num_sim, ratio, agent_type_count_dict,
+                      plot_dir=PLOT_DIR):
+    from plot_utils import plot_path, plot_agent_count
+    plot_url = plot_path(plot_dir, f"mix_comp_agent_count_plot_n={n}_"
+                         f"#rounds={num_round}_"f"#sim={num_sim}_"
+                         f"ratio={ratio}.png")
     title=f"n={n} #rounds={num_round} #simulations={num_sim} ratio={ratio}"
-    plot_agent_count(plot_url, title, agent_type_count_dict, agent_label_arr)
-        
-
-
-def plot_losses(plot_url, title, loss_dicts, agent_label_arr):
-    
-    full_loss = loss_dicts[0]
-    part_loss = loss_dicts[1]
-
-    if "tele" not in full_loss or "deon" not in full_loss or \
-            "tele" not in part_loss or "deon" not in part_loss:
-        raise ValueError("loss dict doesn't contain required keys:"
-                         "tele\", \"deon\"")
-
-    fig, axes = plt.subplots(1, 2, figsize=[15, 6])
-    fig.tight_layout(rect=(0, 0, 1, 0.9))
-    fig.suptitle(title, fontsize=20)
-
-    axes[0].plot(agent_label_arr, part_loss["tele"],
-                 label="partical information", marker="o")
-    axes[0].plot(agent_label_arr, full_loss["tele"],
-                 label="full information", marker="o")
-    axes[0].set_title("teleology loss")
-    axes[0].legend()
-
-    axes[1].plot(agent_label_arr, part_loss["deon"],
-                 label="partial information", marker="o")
-    axes[1].plot(agent_label_arr, full_loss["deon"],
-                 label="full information", marker="o")
-    axes[1].set_title("deontology loss")
-    axes[1].legend()
-
-    print(f"save loss plot at={plot_url}")
-    fig.savefig(plot_url)
-
-
-def plot_agent_count(plot_url, title, count_dict, agent_label_arr):
-    if LossType.TELE.value not in count_dict \
-        or LossType.DEON.value not in count_dict:
-        raise ValueError("count dict doesn't contain required keys:"
-                         "\"teleology\", \"deontology\"")
-
-    fig, axes = plt.subplots(2, 1, figsize=[18, 10])
-    fig.tight_layout(rect=(0.01, 0.01, 1, 0.95))
-    plt.subplots_adjust(hspace=0.2)
-    fig.suptitle(title, fontsize=20)
-    for loss_i, loss_type in enumerate([LossType.TELE, LossType.DEON]):
-        data = [[round_dict[label] for round_dict in
-                 count_dict[loss_type.value]] for label in agent_label_arr]
-        X = np.arange(len(count_dict[loss_type.value]))*2-0.5
-        axes[loss_i].set_title(loss_type.value+" loss")
-        axes[loss_i].set_xticks(np.arange(len(count_dict[loss_type.value]))*2)
-        axes[loss_i].set_xticklabels(np.arange(len(count_dict[loss_type.value])))
-        axes[loss_i].set_xlabel("competition rounds")
-        axes[loss_i].set_ylabel("trolly agent count")
-        for label_i, label in enumerate(agent_label_arr):
-            axes[loss_i].bar(X + 0.25*label_i, data[label_i], width=0.25,
-                             label=label if loss_i == 0 else "")
-    fig.legend()
-    fig.savefig(plot_url)
+    plot_agent_count(plot_url, title, agent_type_count_dict, AGENT_LABEL_ARR)
+
+
+def mix_comp_rep_cell(n, loss_type, num_replicates=1000, num_round=10,
+                      num_sim=100, ratio=0.1, seed=0, agent_stats=False,
+                      window=None, decay=None):
+    """
+    one loss type of the mixed competition experiment, repeated over
+    num_replicates independent populations with the batched EvolutionEngine
+    agent_stats, window, decay: selection statistics, see mix_comp_cell
+    return: (mean, std) lists of {agent label: count} for each round
+    """
+    engine = EvolutionEngine(AGENT_CONS_ARR, n, num_replicates, full_info=1,
+                             seed=seed)
+    result = engine.run(loss_type, num_round, num_sim, ratio,
+                        agent_stats=agent_stats, window=window, decay=decay)
+    return tuple([dict(zip(result["labels"], round_count.tolist()))
+                  for round_count in result[key]] for key in ["mean", "std"])
+
+
+def mix_comp_rep_exp(n, num_replicates=1000, num_round=10, num_sim=100,
+                     ratio=0.1, seed=0, plot_dir=PLOT_DIR, **selection):
+    """
+    mix_comp_exp averaged over num_replicates replicates, the bars are the
+    mean agent counts and the error bars their std across replicates
+    plot_dir: directory of the plot, None to skip plotting
+    selection: agent_stats, window, decay of mix_comp_cell
+    return: {"mean": {loss type: ...}, "std": {loss type: ...}}, see
+            mix_comp_rep_cell
+    """
+    mean_dict, std_dict = {}, {}
+    for loss_type in [LossType.TELE, LossType.DEON]:
+        mean_dict[loss_type.value], std_dict[loss_type.value] = \
+            mix_comp_rep_cell(n, loss_type, num_replicates, num_round,
+                              num_sim, ratio, seed, **selection)
+    if plot_dir is not None:
+        from plot_utils import plot_path, plot_agent_count
+        plot_url = plot_path(plot_dir, f"mix_comp_rep_agent_count_plot_n={n}_"
+                             f"#replicates={num_replicates}_#rounds={num_round}_"
+                             f"#sim={num_sim}_ratio={ratio}.png")
+        title = f"n={n} #replicates={num_replicates} #rounds={num_round} " \
+                f"#simulations={num_sim} ratio={ratio}"
+        plot_agent_count(plot_url, title, mean_dict, AGENT_LABEL_ARR,
+                         err_dict=std_dict)
+    return {"mean": mean_dict, "std": std_dict}
+
+
+def run_cell(cell):
+    """run one (experiment, n, full_info/loss_type) cell of the sweep"""
+    params = dict(cell.params)
+    if cell.exp == "homo":
+        return homo_cell(cell.n, cell.mode, **params)
+    elif cell.exp == "mix":
+        return mix_cell(cell.n, cell.mode, **params)
+    elif cell.exp == "mix_comp":
+        return mix_comp_cell(cell.n, LossType(cell.mode), **params)
+    elif cell.exp == "mix_comp_rep":
+        return mix_comp_rep_cell(cell.n, LossType(cell.mode), **params)
+    raise ValueError(f"unknown experiment={cell.exp}")
+
+
+def cell_definition(cell):
+    """
+    everything the result of a cell depends on, including the source of
+    every module it may use, hashed into its cache key
+    """
+    return {"exp": cell.exp, "n": cell.n, "mode": cell.mode,
+            "params": {key: value for key, value in cell.params
+                       if key not in NON_RESULT_PARAMS},
+            "agents": AGENT_LABEL_ARR,
+            "track_max": TRACK_MAX,
+            "pass_max": PASS_MAX,
+            "code_version": source_version(
+                os.path.dirname(os.path.abspath(__file__)), NON_RESULT_SOURCES)}
+
+
+def run_cached_cells(cells, cache_dir=None, num_workers=None):
+    """
+    run_sweep of run_cell that only runs the cells missing from the result
+    cache in cache_dir (no cache if None) and adds their results to it
+    return: {cell: result}
+    """
+    if cache_dir is None:
+        return run_sweep(run_cell, cells, num_workers=num_workers)
+    cache = ResultCache(cache_dir)
+    keys = {cell: cache_key(cell_definition(cell)) for cell in cells}
+    results = {}
+    for cell in cells:
+        result = cache.get(keys[cell])
+        if result is not None:
+            results[cell] = result
+    missing_cells = [cell for cell in cells if cell not in results]
+    print(f"result cache: {len(results)} cached cells, "
+          f"{len(missing_cells)} to run")
+    new_results = run_sweep(run_cell, missing_cells, num_workers=num_workers)
+    for cell, result in new_results.items():
+        cache.put(keys[cell], result)
+    results.update(new_results)
+    return results
+
+
+def sweep(homo_n_arr, mix_n_arr, mix_comp_n_arr, num_round=10, num_sim=100,
+          ratio=0.2, seed=0, num_workers=None, num_trials=1000,
+          ci_halfwidth=None, checkpoint_dir=None, cache_dir=None,
+          plot_dir=PLOT_DIR, agent_stats=False, window=None, decay=None):
+    """
+    run every experiment cell of the grid on a process pool, then plot
+    num_workers: number of worker processes, 1 runs the cells in process
+    num_trials, ci_halfwidth: trial budget of the homo/mix cells, see homo_cell
+    checkpoint_dir: checkpoint every mix_comp cell in this directory, a
+                    killed sweep resumes them from their last round
+    cache_dir: directory of the result cache, only the cells that aren't
+               cached yet are run, see cache_utils
+    plot_dir: directory of the plots, None to skip plotting
+    agent_stats, window, decay: selection statistics of the mix_comp cells,
+                                see mix_comp_cell
+    return: {cell: result}
+    """
+    selection = selection_kwargs(agent_stats, window, decay)
+    loss_kwargs = {"seed": seed, "num_trials": num_trials,
+                   "ci_halfwidth": ci_halfwidth}
+    comp_kwargs = {"num_round": num_round, "num_sim": num_sim,
+                   "ratio": ratio, "seed": seed, **selection}
+    homo_cells = {n: [make_cell("homo", n, full_info, **loss_kwargs)
+                      for full_info in [0, 1]] for n in homo_n_arr}
+    mix_cells = {n: [make_cell("mix", n, full_info, **loss_kwargs)
+                     for full_info in [0, 1]] for n in mix_n_arr}
+    mix_comp_cells = {}
+    for n in mix_comp_n_arr:
+        mix_comp_cells[n] = {}
+        for loss_type in [LossType.TELE, LossType.DEON]:
+            cell = make_cell("mix_comp", n, loss_type.value, **comp_kwargs)
+            mix_comp_cells[n][loss_type.value] = make_cell(
+                "mix_comp", n, loss_type.value, **comp_kwargs,
+                **mix_comp_checkpoint(checkpoint_dir, cell))
+    cells = [cell for n_cells in homo_cells.values() for cell in n_cells]
+    cells += [cell for n_cells in mix_cells.values() for cell in n_cells]
+    cells += [cell for n_cells in mix_comp_cells.values()
+              for cell in n_cells.values()]
+    results = run_cached_cells(cells, cache_dir, num_workers)
+    if plot_dir is None:
+        return results
+
+    for n, n_cells in homo_cells.items():
+        plot_homo_exp(n, [results[cell] for cell in n_cells], plot_dir)
+    for n, n_cells in mix_cells.items():
+        plot_mix_exp(n, [results[cell] for cell in n_cells], plot_dir)
+    for n, n_cells in mix_comp_cells.items():
+        count_dict = {key: results[cell] for key, cell in n_cells.items()}
+        plot_mix_comp_exp(n, num_round, num_sim, ratio, count_dict, plot_dir)
+    return results
 
 
 def main():
@@ -237,11 +596,153 @@ def main():
 
 
 
+def n_list(text):
+    """argparse type of a list of n, e.g. 5,10,20 or a range 5:101:5"""
+    if ":" in text:
+        return list(range(*[int(part) for part in text.split(":")]))
+    return [int(part) for part in text.split(",")]
+
+
+def cell_name(cell):
+    """return: "exp/n=.../mode" name of a sweep cell in the saved results"""
+    return f"{cell.exp}/n={cell.n}/{cell.mode}"
+
+
+def cli(argv=None):
+    """
+    command line entry point, one subcommand per experiment, e.g. (from src/)
+        python main.py homo --n 5,20 --num-trials 10000 --out homo.json
+        python main.py mix-comp --n 5:101:5 --plot-dir ../plots
+        python main.py sweep --out grid.npz --plot-dir ../plots
+    nothing is plotted (and matplotlib never imported) without --plot-dir
+    """
+    parser = argparse.ArgumentParser(description="multi-agent trolly problem "
+                                                 "experiments")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sub = {}
+    for name, help_text in [
+            ("demo", "run a few trials of 5 trollies and print the losses"),
+            ("homo", "homogenous experiment, one agent type at a time"),
+            ("homo-crn", "homogenous experiment on a common scenario bank"),
+            ("mix", "mixed experiment, every agent type on one ring"),
+            ("mix-comp", "mixed competition, the best agents replace the worst"),
+            ("mix-comp-rep", "mixed competition over many replicates"),
+            ("sweep", "every homo/mix/mix-comp cell of a grid of n")]:
+        sub[name] = commands.add_parser(name, help=help_text)
+        if name == "demo":
+            continue
+        sub[name].add_argument("--seed", type=int, default=0,
+                               help="random seed of every cell")
+        sub[name].add_argument("--out", default=None,
+                               help="save the results to this .json or .npz file")
+        sub[name].add_argument("--plot-dir", default=None,
+                               help="save the plots in this directory")
+        if name != "sweep":
+            sub[name].add_argument("--n", type=n_list, required=True,
+                                   help="numbers of trollies, 5,10 or start:stop:step")
+    for name in ["homo", "homo-crn", "mix", "sweep"]:
+        sub[name].add_argument("--num-trials", type=int, default=1000,
+                               help="number of trials (maximum with --ci-halfwidth)")
+    for name in ["homo", "mix", "sweep"]:
+        sub[name].add_argument("--ci-halfwidth", type=float, default=None,
+                               help="stop once the 95%% confidence intervals "
+                                    "are this narrow")
+    for name in ["homo", "mix"]:
+        sub[name].add_argument("--exact", action="store_true",
+                               help="exact expected losses instead of trials")
+    for name in ["homo", "mix", "mix-comp"]:
+        sub[name].add_argument("--instrument", action="store_true",
+                               help="print a timing and counter summary")
+    for name in ["mix-comp", "mix-comp-rep", "sweep"]:
+        sub[name].add_argument("--num-round", type=int, default=10,
+                               help="number of competition rounds")
+        sub[name].add_argument("--num-sim", type=int, default=100,
+                               help="number of trials per round")
+        sub[name].add_argument("--ratio", type=float, default=0.2,
+                               help="fraction of agents replaced per round")
+        sub[name].add_argument("--agent-stats", action="store_true",
+                               help="select by per-agent instead of per-slot stats")
+        sub[name].add_argument("--window", type=int, default=None,
+                               help="per-agent stats of the last rounds only, "
+                                    "implies --agent-stats")
+        sub[name].add_argument("--decay", type=float, default=None,
+                               help="per-round decay of the per-agent stats, "
+                                    "implies --agent-stats")
+    for name in ["mix-comp", "sweep"]:
+        sub[name].add_argument("--checkpoint-dir", default=None,
+                               help="checkpoint the competitions in this directory")
+    sub["homo-crn"].add_argument("--bank-dir", default=os.path.join("..", "banks"),
+                                 help="directory of the scenario banks")
+    sub["mix-comp-rep"].add_argument("--num-replicates", type=int, default=1000,
+                                     help="number of independent replicates")
+    sub["sweep"].add_argument("--homo-n", type=n_list, default=[2, 5, 15, 20, 50, 100],
+                              help="n grid of the homo cells")
+    sub["sweep"].add_argument("--mix-n", type=n_list, default=list(range(5, 101, 5)),
+                              help="n grid of the mix cells")
+    sub["sweep"].add_argument("--mix-comp-n", type=n_list,
+                              default=list(range(5, 101, 5)),
+                              help="n grid of the mix_comp cells")
+    sub["sweep"].add_argument("--num-workers", type=int, default=None,
+                              help="number of worker processes, one per cpu by default")
+    sub["sweep"].add_argument("--cache-dir", default=os.path.join("..", "cache"),
+                              help="directory of the result cache")
+    sub["sweep"].add_argument("--no-cache", action="store_true",
+                              help="run every cell, ignoring the result cache")
+    args = parser.parse_args(argv)
+    if getattr(args, "window", None) is not None or \
+            getattr(args, "decay", None) is not None:
+        args.agent_stats = True
+
+    if args.command == "demo":
+        main()
+        return 0
+    if args.command == "sweep":
+        results = sweep(args.homo_n, args.mix_n, args.mix_comp_n,
+                        num_round=args.num_round, num_sim=args.num_sim,
+                        ratio=args.ratio, seed=args.seed,
+                        num_workers=args.num_workers, num_trials=args.num_trials,
+                        ci_halfwidth=args.ci_halfwidth,
+                        checkpoint_dir=args.checkpoint_dir,
+                        cache_dir=None if args.no_cache else args.cache_dir,
+                        plot_dir=args.plot_dir, agent_stats=args.agent_stats,
+                        window=args.window, decay=args.decay)
+        results = {cell_name(cell): result for cell, result in results.items()}
+    else:
+        results = {}
+        for n in args.n:
+            if args.command == "homo":
+                results[n] = homo_exp(n, args.seed, args.exact, args.num_trials,
+                                      args.ci_halfwidth, args.instrument,
+                                      plot_dir=args.plot_dir)
+            elif args.command == "homo-crn":
+                results[n] = homo_crn_exp(n, args.num_trials, args.seed,
+                                          args.bank_dir, plot_dir=args.plot_dir)
+            elif args.command == "mix":
+                results[n] = mix_exp(n, args.seed, args.exact, args.num_trials,
+                                     args.ci_halfwidth, args.instrument,
+                                     plot_dir=args.plot_dir)
+            elif args.command == "mix-comp":
+                results[n] = mix_comp_exp(n, args.num_round, args.num_sim,
+                                          args.ratio, args.seed, args.instrument,
+                                          args.checkpoint_dir,
+                                          plot_dir=args.plot_dir,
+                                          **selection_kwargs(args.agent_stats,
+                                                             args.window,
+                                                             args.decay))
+            elif args.command == "mix-comp-rep":
+                results[n] = mix_comp_rep_exp(n, args.num_replicates,
+                                              args.num_round, args.num_sim,
+                                              args.ratio, args.seed,
+                                              plot_dir=args.plot_dir,
+                                              **selection_kwargs(args.agent_stats,
+                                                                 args.window,
+                                                                 args.decay))
+    if args.out is not None:
+        params = {key: value for key, value in vars(args).items()
+                  if key not in ["out", "plot_dir"]}
+        save_results(args.out, {"params": params, "results": results})
+    return 0
+
+
 if __name__ == "__main__":
-    main()
-    for n in [2, 5, 15, 20, 50, 100]:
-        homo_exp(n)
-    for n in [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100]:
-        mix_exp(n)
-    for n in [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100]:
-        mix_comp_exp(n=n, num_round=10, num_sim=100, ratio=0.2)
+    sys.exit(cli())
@@ -0,0 +1,88 @@
+"""
+Plots of the experiment results, imported by main only when plotting is
+requested so compute-only runs never load matplotlib
+"""
+import os
+import matplotlib
+# plots are only saved to files, never shown, so headless workers need no display
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from sim_utils import LossType
+
+
+def plot_path(plot_dir, file_name):
+    """return: path of file_name in plot_dir, creating the directory"""
+    os.makedirs(plot_dir, exist_ok=True)
+    return os.path.join(plot_dir, file_name)
+
+
+def plot_losses(plot_url, title, loss_dicts, agent_label_arr):
+    
+    full_loss = loss_dicts[0]
+    part_loss = loss_dicts[1]
+
+    if "tele" not in full_loss or "deon" not in full_loss or \
+            "tele" not in part_loss or "deon" not in part_loss:
+        raise ValueError("loss dict doesn't contain required keys:"
+                         "tele\", \"deon\"")
+
+    fig, axes = plt.subplots(1, 2, figsize=[15, 6])
+    fig.tight_layout(rect=(0, 0, 1, 0.9))
+    fig.suptitle(title, fontsize=20)
+
+    axes[0].errorbar(agent_label_arr, part_loss["tele"],
+                     yerr=part_loss.get("tele_ci"), capsize=3,
+                     label="partical information", marker="o")
+    axes[0].errorbar(agent_label_arr, full_loss["tele"],
+                     yerr=full_loss.get("tele_ci"), capsize=3,
+                     label="full information", marker="o")
+    axes[0].set_title("teleology loss")
+    axes[0].legend()
+
+    axes[1].errorbar(agent_label_arr, part_loss["deon"],
+                     yerr=part_loss.get("deon_ci"), capsize=3,
+                     label="partial information", marker="o")
+    axes[1].errorbar(agent_label_arr, full_loss["deon"],
+                     yerr=full_loss.get("deon_ci"), capsize=3,
+                     label="full information", marker="o")
+    axes[1].set_title("deontology loss")
+    axes[1].legend()
+
+    print(f"save loss plot at={plot_url}")
+    fig.savefig(plot_url)
+    plt.close(fig)
+
+
+def plot_agent_count(plot_url, title, count_dict, agent_label_arr, err_dict=None):
+    """
+    err_dict: optional error bar sizes, same layout as count_dict
+    """
+    if LossType.TELE.value not in count_dict \
+        or LossType.DEON.value not in count_dict:
+        raise ValueError("count dict doesn't contain required keys:"
+                         "\"teleology\", \"deontology\"")
+
+    fig, axes = plt.subplots(2, 1, figsize=[18, 10])
+    fig.tight_layout(rect=(0.01, 0.01, 1, 0.95))
+    plt.subplots_adjust(hspace=0.2)
+    fig.suptitle(title, fontsize=20)
+    for loss_i, loss_type in enumerate([LossType.TELE, LossType.DEON]):
+        data = [[round_dict[label] for round_dict in
+                 count_dict[loss_type.value]] for label in agent_label_arr]
+        X = np.arange(len(count_dict[loss_type.value]))*2-0.5
+        axes[loss_i].set_title(loss_type.value+" loss")
+        axes[loss_i].set_xticks(np.arange(len(count_dict[loss_type.value]))*2)
+        axes[loss_i].set_xticklabels(np.arange(len(count_dict[loss_type.value])))
+        axes[loss_i].set_xlabel("competition rounds")
+        axes[loss_i].set_ylabel("trolly agent count")
+        if err_dict is not None:
+            err = [[round_dict[label] for round_dict in
+                    err_dict[loss_type.value]] for label in agent_label_arr]
+        for label_i, label in enumerate(agent_label_arr):
+            axes[loss_i].bar(X + 0.25*label_i, data[label_i], width=0.25,
+                             yerr=None if err_dict is None else err[label_i],
+                             label=label if loss_i == 0 else "")
+    fig.legend()
+    fig.savefig(plot_url)
+    plt.close(fig)
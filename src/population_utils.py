@@ -0,0 +1,164 @@
+"""
+Compact struct-of-arrays representation of a trolly population
+"""
+import numpy as np
+
+# type code of an empty slot
+NO_TYPE = -1
+
+
+class Population:
+    """
+    population of n trollies stored as one small integer type code per
+    trolly plus a table of agent types, agents with equal batch keys share
+    one type (and one agent object deciding for all of them)
+    codes: (n,) type code of every trolly, int8 until more than 127 types
+           are in use
+    types: agent of every type code, the agent objects of the trollies are
+           only an optional view, see agent and agent_arr
+    """
+    def __init__(self, n):
+        """
+        n: number of trollies
+        """
+        self.n = n
+        self.codes = np.full(n, NO_TYPE, dtype=np.int8)
+        self.types = []
+        self.labels = []
+        self.type_idx = {}  # type code by batch key
+
+    @classmethod
+    def from_codes(cls, types, codes):
+        """
+        build a population without one agent object per trolly
+        types: agent of every type code
+        codes: (n,) type code of every trolly
+        """
+        population = cls(len(codes))
+        codes = np.asarray(codes)
+        if codes.min() < 0 or codes.max() >= len(types):
+            raise ValueError(f"type codes must be in [0, {len(types)})")
+        population.codes = population.replace_types(types)[codes]
+        return population
+
+    def __len__(self):
+        return self.n
+
+    def add_type(self, agent):
+        """return: type code of agent, registered under its batch key"""
+        key = agent.batch_key()
+        if key not in self.type_idx:
+            if len(self.types) > np.iinfo(self.codes.dtype).max:
+                self.compact()
+            if len(self.types) > np.iinfo(self.codes.dtype).max:
+                self.codes = self.codes.astype(
+                    np.promote_types(self.codes.dtype,
+                                     np.min_scalar_type(-len(self.types)-1)))
+            self.type_idx[key] = len(self.types)
+            self.types.append(agent)
+            self.labels.append(str(agent))
+        return self.type_idx[key]
+
+    def replace_types(self, agents):
+        """
+        replace the type table with the distinct batch keys of agents, a
+        known key keeps its agent, every code needs to be rebuilt after
+        return: (len(agents),) type code of every agent
+        """
+        keys = [agent.batch_key() for agent in agents]
+        types = {}
+        for key, agent in zip(keys, agents):
+            if key not in types:
+                code = self.type_idx.get(key)
+                types[key] = agent if code is None else self.types[code]
+        self.types = list(types.values())
+        self.labels = [str(agent) for agent in self.types]
+        self.type_idx = {key: code for code, key in enumerate(types)}
+        dtype = np.promote_types(np.int8, np.min_scalar_type(-len(self.types)-1))
+        return np.array([self.type_idx[key] for key in keys], dtype=dtype)
+
+    def compact(self):
+        """drop the types no trolly uses anymore and renumber the rest"""
+        used = np.flatnonzero(self.count_types() > 0)
+        code_map = np.full(len(self.types)+1, NO_TYPE, dtype=np.int64)
+        code_map[used] = np.arange(len(used))
+        self.codes = code_map[self.codes].astype(self.codes.dtype)
+        self.types = [self.types[code] for code in used]
+        self.labels = [self.labels[code] for code in used]
+        self.type_idx = {agent.batch_key(): code
+                         for code, agent in enumerate(self.types)}
+
+    def __setstate__(self, state):
+        # batch keys of the agents without a shared key are object ids,
+        # they change when the agents are unpickled
+        self.__dict__.update(state)
+        self.type_idx = {agent.batch_key(): code
+                         for code, agent in enumerate(self.types)}
+
+    def set_agent(self, idx, agent):
+        self.codes[idx] = self.add_type(agent)
+
+    def set_agents(self, agent_arr):
+        """
+        replace every trolly, the types none of the new agents has are
+        dropped (never compacted against the codes being replaced)
+        """
+        assert len(agent_arr) == self.n
+        self.codes = self.replace_types(agent_arr)
+
+    def agent(self, idx):
+        """agent deciding for trolly idx, None if unset"""
+        code = self.codes[idx]
+        return None if code == NO_TYPE else self.types[code]
+
+    def agent_arr(self):
+        """list view of the agent of every trolly"""
+        return [None if code == NO_TYPE else self.types[code]
+                for code in self.codes.tolist()]
+
+    def label(self, idx):
+        return str(self.agent(idx))
+
+    def label_arr(self):
+        return [self.labels[code] if code != NO_TYPE else str(None)
+                for code in self.codes.tolist()]
+
+    def param_table(self, name):
+        """
+        per-type table of an agent parameter (e.g. pass_max), index it with
+        codes to get the parameter of every trolly
+        """
+        return np.array([getattr(agent, name) for agent in self.types])
+
+    def is_full(self):
+        return not np.any(self.codes == NO_TYPE)
+
+    def count_types(self):
+        """return: number of trollies of every type code"""
+        return np.bincount(self.codes[self.codes != NO_TYPE],
+                           minlength=len(self.types))
+
+    def groups(self):
+        """return: list of (type code, trolly indices) of the types in use"""
+        order = np.argsort(self.codes, kind="stable")
+        counts = self.count_types()
+        start = np.count_nonzero(self.codes == NO_TYPE)
+        groups = []
+        for code in np.flatnonzero(counts):
+            groups.append((int(code), order[start:start+counts[code]]))
+            start += counts[code]
+        return groups
+
+    def label_masks(self):
+        """return: {label: boolean mask of the trollies with that label}"""
+        label_codes = {}
+        for code in np.flatnonzero(self.count_types()):
+            label_codes.setdefault(self.labels[code], []).append(code)
+        return {label: np.isin(self.codes, codes)
+                for label, codes in label_codes.items()}
+
+    def permute(self, order):
+        self.codes = self.codes[order]
+
+    def nbytes(self):
+        return self.codes.nbytes
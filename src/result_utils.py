@@ -0,0 +1,57 @@
+"""
+Utilities for saving experiment results as json or npz
+"""
+import os, sys, json
+import numpy as np
+
+
+def to_json(obj):
+    """
+    return: obj with its numpy values converted to python ones and every
+            dict key to a string
+    """
+    if isinstance(obj, dict):
+        return {str(key): to_json(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(value) for value in obj]
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    return obj
+
+
+def flatten_results(obj, prefix=""):
+    """
+    return: {"key/sub key/...": array} of the nested dicts and lists of obj,
+            lists of numbers are kept as one array, None values are left out
+    """
+    if obj is None:
+        return {}
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple)) and \
+            any(isinstance(value, (dict, list, tuple, str)) for value in obj):
+        items = enumerate(obj)
+    else:
+        return {prefix or "result": np.asarray(obj)}
+    arrays = {}
+    for key, value in items:
+        arrays.update(flatten_results(value, f"{prefix}/{key}" if prefix else str(key)))
+    return arrays
+
+
+def save_results(path, results):
+    """
+    save results (nested dicts and lists of numbers, strings and arrays)
+    path: .json file, or .npz file of flatten_results
+    """
+    dir_name = os.path.dirname(path)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    if path.endswith(".npz"):
+        np.savez(path, **flatten_results(results))
+    elif path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(to_json(results), f, indent=2)
+    else:
+        raise ValueError(f"unknown result file type={path}, use .json or .npz")
+    print(f"save results at={path}", file=sys.stderr)
@@ -0,0 +1,116 @@
+"""
+Utilities for common random numbers: a bank of pre-drawn scenarios (track
+and passenger numbers of every trial) that every agent type and information
+mode is run against, so their losses can be compared trial by trial
+"""
+import os, json, shutil, tempfile
+import numpy as np
+from sim_utils import make_rng
+
+META = "bank.json"
+# every file of a bank directory
+BANK_FILES = {META, "track_nums.npy", "pass_nums.npy"}
+# number of trolly draws per generated / replayed batch
+CHUNK_CELLS = 2 * 10**6
+
+
+class ScenarioBank:
+    """
+    read-only memory-mapped scenario bank, the arrays are shared through the
+    page cache by every process opening the same bank
+    track_nums: (num_trials, num_tracks) number of people on each track
+    pass_nums: (num_trials, n) number of passengers on each trolly
+    """
+    def __init__(self, path):
+        """
+        path: bank directory written by ScenarioBank.create
+        """
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        self.n = self.meta["n"]
+        self.num_tracks = self.meta["num_tracks"]
+        self.num_trials = self.meta["num_trials"]
+        self.track_max = self.meta["track_max"]
+        self.pass_max = self.meta["pass_max"]
+        self.track_nums = np.load(os.path.join(path, "track_nums.npy"), mmap_mode="r")
+        self.pass_nums = np.load(os.path.join(path, "pass_nums.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.num_trials
+
+    @classmethod
+    def create(cls, path, n, num_trials, seed=0, num_tracks=None, track_max=5,
+               pass_max=5):
+        """
+        draw a bank (chunk by chunk, never fully in memory) and save it, an
+        existing bank at path with the same parameters is reused as is
+        n: number of trollies
+        num_trials: number of scenarios
+        seed: random seed of the draws
+        num_tracks: number of tracks, n (a ring) by default
+        return: the ScenarioBank
+        """
+        num_tracks = n if num_tracks is None else num_tracks
+        meta = {"n": n, "num_tracks": num_tracks, "num_trials": num_trials,
+                "seed": seed, "track_max": track_max, "pass_max": pass_max}
+        meta_path = os.path.join(path, META)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    return cls(path)
+        if os.path.exists(path) and not set(os.listdir(path)) <= BANK_FILES:
+            raise ValueError(f"{path} exists and is not a scenario bank")
+        # the bank is written next to path and moved into place once
+        # complete, processes still mapping an old bank keep reading it
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(os.path.abspath(path)) + ".",
+                                    dir=parent)
+        try:
+            cls.draw(tmp_path, meta)
+            if os.path.exists(path):
+                old_path = tmp_path + ".old"
+                os.replace(path, old_path)
+                os.replace(tmp_path, path)
+                shutil.rmtree(old_path)
+            else:
+                os.replace(tmp_path, path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls(path)
+
+    @staticmethod
+    def draw(path, meta):
+        """draw the arrays of a bank into the empty directory path"""
+        rng = make_rng(meta["seed"])
+        dtype = np.min_scalar_type(-max(meta["track_max"], meta["pass_max"]))
+        columns = [("track_nums", meta["num_tracks"], meta["track_max"]),
+                   ("pass_nums", meta["n"], meta["pass_max"])]
+        arrs = {name: np.lib.format.open_memmap(
+                    os.path.join(path, name + ".npy"), mode="w+", dtype=dtype,
+                    shape=(meta["num_trials"], width))
+                for name, width, _ in columns}
+        chunk = max(1, CHUNK_CELLS // (meta["n"] + meta["num_tracks"]))
+        for start in range(0, meta["num_trials"], chunk):
+            stop = min(start + chunk, meta["num_trials"])
+            for name, width, high in columns:
+                arrs[name][start:stop] = rng.integers(
+                    0, high+1, size=(stop-start, width), dtype=dtype)
+        for arr in arrs.values():
+            arr.flush()
+        del arrs
+        # the meta file marks the bank as complete
+        with open(os.path.join(path, META), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def iter_batches(self, batch_trials=None, start=0, stop=None):
+        """
+        yield: (track_nums, pass_nums) batches of the scenarios start..stop
+        """
+        batch_trials = batch_trials or max(1, CHUNK_CELLS // (self.n + self.num_tracks))
+        stop = self.num_trials if stop is None else min(stop, self.num_trials)
+        for batch_start in range(start, stop, batch_trials):
+            batch_stop = min(batch_start + batch_trials, stop)
+            yield (np.asarray(self.track_nums[batch_start:batch_stop]),
+                   np.asarray(self.pass_nums[batch_start:batch_stop]))
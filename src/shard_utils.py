@@ -0,0 +1,258 @@
+"""
+Sharded simulation of one large ring across worker processes
+
+The ring is split into contiguous segments, one per worker. The main process
+draws every trial exactly like Simulator (same stream, same results) into
+multiprocessing.shared_memory arrays, then the workers decide and resolve
+the collisions of their own segment in place. A segment only reads the one
+trolly/track halo on each side of it from its neighbor segments (the
+wraparound neighbors of trolly_track_lookup), and sends its partial per-trial
+sums back to be reduced into the usual accumulators.
+"""
+import os, time, weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from sim_utils import Simulator, TRACK_MAX, PASS_MAX
+from agents_utils import CompiledAgent
+
+# number of trolly decisions per batch written to shared memory
+CHUNK_CELLS = 2 * 10**6
+# per-trial partial sums of a segment, followed by 4 sums per agent label
+TRIAL_COLUMNS = ["pass_kill", "kill", "pass", "track", "collisions"]
+
+# shared arrays of the worker process, see _attach_shards
+_shared = {}
+
+
+def _attach_shards(specs):
+    """worker initializer, map the shared arrays of the main process"""
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _segment_view(name, k, lo, hi):
+    """
+    return: (k, hi-lo+2) columns lo-1..hi of a shared (trials, n) array,
+            wrapping around the ring
+    """
+    arr = _shared[name][1][:k]
+    return arr[:, np.arange(lo-1, hi+1) % arr.shape[1]]
+
+
+def _decide_segment(lo, hi, k, policies, full_info):
+    """decide for the trollies lo..hi-1 of the first k shared trials"""
+    codes = _shared["codes"][1][lo:hi]
+    pass_nums = _segment_view("pass_nums", k, lo, hi)
+    track_nums = _segment_view("track_nums", k, lo, hi)
+    decisions = _shared["decisions"][1][:k, lo:hi]
+    for code in np.unique(codes):
+        mask = codes == code
+        if full_info:
+            neigh_pass_nums = (pass_nums[:, :-2][:, mask].ravel(),
+                               pass_nums[:, 2:][:, mask].ravel())
+        else:
+            neigh_pass_nums = ()
+        decisions[:, mask] = np.reshape(policies[code].decide_batch(
+            pass_nums[:, 1:-1][:, mask].ravel(), track_nums[:, 1:-1][:, mask].ravel(),
+            track_nums[:, 2:][:, mask].ravel(), *neigh_pass_nums), (k, mask.sum()))
+
+
+def _resolve_segment(lo, hi, k, code_labels, num_labels):
+    """
+    resolve the collisions of trollies (and tracks) lo..hi-1 of the first k
+    shared trials, see topology_utils.ring_outcome
+    the per-trolly sums of the batch are written to the shared accumulators
+    return: (k, len(TRIAL_COLUMNS) + 4*num_labels) per-trial partial sums
+    """
+    stay = _segment_view("decisions", k, lo, hi) == 0
+    track_ext = _segment_view("track_nums", k, lo, hi)
+    pass_nums = _shared["pass_nums"][1][:k, lo:hi]
+    track_nums = track_ext[:, 1:-1]
+    mid_stay = stay[:, 1:-1]
+    switch_in = ~stay[:, :-2]
+    occupancy = mid_stay.astype(np.int8) + switch_in
+    collided = np.where(mid_stay, switch_in, stay[:, 2:])
+    pass_kills = np.where(collided, pass_nums, 0)
+    track_kills = np.where(mid_stay, track_nums, track_ext[:, 2:])
+    # the draws are compact ints, upcast before adding them up
+    trolly_ecounter = pass_nums.astype(np.int64) + track_nums + track_ext[:, 2:]
+
+    acc = _shared["acc"][1]
+    acc[0, lo:hi] = pass_kills.sum(axis=0)
+    acc[1, lo:hi] = track_kills.sum(axis=0)
+    acc[2, lo:hi] = pass_nums.sum(axis=0)
+    acc[3, lo:hi] = track_nums.sum(axis=0) + track_ext[:, 2:].sum(axis=0)
+
+    sums = np.zeros((k, len(TRIAL_COLUMNS) + 4*num_labels), dtype=np.int64)
+    sums[:, 0] = pass_kills.sum(axis=1)
+    sums[:, 1] = sums[:, 0] + (track_nums * (occupancy > 0)).sum(axis=1)
+    sums[:, 2] = pass_nums.sum(axis=1)
+    sums[:, 3] = track_nums.sum(axis=1)
+    sums[:, 4] = np.count_nonzero(occupancy > 1, axis=1)
+    labels = code_labels[_shared["codes"][1][lo:hi]]
+    trolly_kills = pass_kills.astype(np.int64) + track_kills
+    for label in np.unique(labels):
+        mask = labels == label
+        col = len(TRIAL_COLUMNS) + 4*label
+        sums[:, col] = trolly_kills[:, mask].sum(axis=1)
+        sums[:, col+1] = trolly_ecounter[:, mask].sum(axis=1)
+        sums[:, col+2] = pass_kills[:, mask].sum(axis=1)
+        sums[:, col+3] = pass_nums[:, mask].sum(axis=1)
+    return sums
+
+
+def _release(executor, shms):
+    executor.shutdown()
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            # arrays of a garbage collected simulator may still view it
+            pass
+        shm.unlink()
+
+
+class ShardedSimulator(Simulator):
+    """
+    Simulator of one ring whose decisions and collisions are computed by
+    num_workers processes on contiguous segments, every run method of
+    Simulator works unchanged and gives exactly the same results
+    only deterministic agents are supported (a random agent's stream would
+    be split across the workers), call close() when done
+    """
+    def __init__(self, n, full_info, seed, num_workers=None, track_max=TRACK_MAX,
+                 pass_max=PASS_MAX):
+        """
+        num_workers: number of worker processes, one per cpu by default
+        see Simulator for the other arguments, policies are always compiled
+        """
+        super().__init__(n, full_info, seed, track_max=track_max,
+                         pass_max=pass_max, compile_policies=True)
+        num_workers = min(n, num_workers or os.cpu_count())
+        bounds = np.linspace(0, n, num_workers+1).astype(int)
+        self.segments = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        self.chunk_trials = max(1, CHUNK_CELLS // n)
+
+        shapes = {"track_nums": ((self.chunk_trials, n), self.draw_dtype),
+                  "pass_nums": ((self.chunk_trials, n), self.draw_dtype),
+                  "decisions": ((self.chunk_trials, n), np.dtype(np.int8)),
+                  "codes": ((n,), np.dtype(np.int32)),
+                  "acc": ((4, n), np.dtype(np.int64))}
+        shms = []
+        specs = {}
+        self.shared = {}
+        for name, (shape, dtype) in shapes.items():
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            shms.append(shm)
+            specs[name] = (shm.name, shape, dtype.str)
+            self.shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            initializer=_attach_shards,
+                                            initargs=(specs,))
+        self._finalizer = weakref.finalize(self, _release, self.executor, shms)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        raise TypeError("a ShardedSimulator can't be pickled or checkpointed")
+
+    def close(self):
+        """stop the workers and free the shared memory"""
+        self.shared = {}
+        self._finalizer()
+
+    def policies(self):
+        """return: compiled agent of every type code"""
+        policies = []
+        for agent in self.population.types:
+            if not agent.deterministic:
+                raise ValueError(f"sharded simulation needs deterministic agents, got {agent}")
+            policy = self.compile_agent(agent.batch_key(), agent)
+            if isinstance(policy, CompiledAgent):
+                # build the table here once, not in every worker task
+                policy.table(self.full_info)
+            policies.append(policy)
+        return policies
+
+    def iter_chunks(self, k, *arrs):
+        """
+        copy the trials of the given (k, n) arrays into the shared arrays of
+        the same name chunk by chunk
+        yield: (start, stop) trials of the chunk in shared memory
+        """
+        for start in range(0, k, self.chunk_trials):
+            stop = min(start + self.chunk_trials, k)
+            for name, arr in arrs:
+                self.shared[name][:stop-start] = arr[start:stop]
+            yield start, stop
+
+    def decide_trials(self, track_nums, pass_nums):
+        """same as Simulator.decide_trials, each worker decides its segment"""
+        if self.instrument is not None:
+            start_time = time.perf_counter()
+        assert self.population.is_full(), "every trolly needs to be set"
+        policies = self.policies()
+        self.shared["codes"][:] = self.population.codes
+        k = track_nums.shape[0]
+        decisions = np.empty((k, self.n), dtype=np.int8)
+        for start, stop in self.iter_chunks(k, ("track_nums", track_nums),
+                                            ("pass_nums", pass_nums)):
+            list(self.executor.map(_decide_segment, *zip(*[
+                (lo, hi, stop-start, policies, self.full_info)
+                for lo, hi in self.segments])))
+            decisions[start:stop] = self.shared["decisions"][:stop-start]
+        if self.instrument is not None:
+            self.instrument.lap("decide", start_time)
+        return decisions
+
+    def record_trials(self, track_nums, pass_nums, decisions):
+        """
+        same as Simulator.record_trials, each worker resolves its segment
+        and the partial sums are reduced here
+        """
+        if self.recorder is not None:
+            self.recorder.record(track_nums, pass_nums, decisions)
+        if self.instrument is not None:
+            start_time = time.perf_counter()
+        label_masks = self.population.label_masks()
+        labels = list(label_masks)
+        code_labels = np.array([labels.index(label) if label in label_masks else -1
+                                for label in self.population.labels] or [-1])
+        self.shared["codes"][:] = self.population.codes
+        k = decisions.shape[0]
+        trial_sums = []
+        for start, stop in self.iter_chunks(k, ("track_nums", track_nums),
+                                            ("pass_nums", pass_nums),
+                                            ("decisions", decisions)):
+            partial_sums = self.executor.map(_resolve_segment, *zip(*[
+                (lo, hi, stop-start, code_labels, len(labels))
+                for lo, hi in self.segments]))
+            trial_sums.append(sum(partial_sums))
+            self.accumulate_trollies(*self.shared["acc"].copy())
+        trial_sums = np.concatenate(trial_sums)
+        if self.instrument is not None:
+            start_time = self.instrument.lap("collide", start_time)
+            self.instrument.count("collisions", int(trial_sums[:, 4].sum()))
+            self.instrument.count("trials", k)
+
+        self.total_trials += k
+        self.total_pass += int(trial_sums[:, 2].sum())
+        self.total_track += int(trial_sums[:, 3].sum())
+        self.total_pass_kill += int(trial_sums[:, 0].sum())
+        self.total_track_kill += int((trial_sums[:, 1] - trial_sums[:, 0]).sum())
+        label_sums = {label: tuple(trial_sums[:, len(TRIAL_COLUMNS) + 4*i + j]
+                                   for j in range(4))
+                      for i, label in enumerate(labels)}
+        trial_losses = self.fold_loss_samples(
+            {column: trial_sums[:, i] for i, column in enumerate(TRIAL_COLUMNS)},
+            label_sums)
+        if self.instrument is not None:
+            self.instrument.lap("stats", start_time)
+        return trial_losses
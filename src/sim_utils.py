@@ -3,9 +3,20 @@ Winston Chen
 5/3/2021
 Utilities for trolly problem simulation enviorment setup
 """
-import random
+import time
 from enum import Enum
 import numpy as np
+from stats_utils import RatioStats, AgentStats
+from instrument_utils import Instrumentation
+from population_utils import Population
+from checkpoint_utils import save_checkpoint, load_checkpoint
+from topology_utils import Topology, ring_outcome
+
+
+# default maximum number of people tied on one track and of passengers on
+# a trolly
+TRACK_MAX = 5
+PASS_MAX = 5
 
 
 class LossType(Enum):
@@ -13,41 +24,92 @@ class LossType(Enum):
     DEON = "deontology"
 
 
+def make_rng(seed):
+    """
+    seed: int, SeedSequence or Generator (None draws fresh entropy)
+    return: numpy Generator owning its own random stream, a Generator is
+            returned as is
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return np.random.Generator(np.random.PCG64(seed))
+
+
+def spawn_rngs(seed, num):
+    """
+    split a seed into num statistically independent child streams, e.g. one
+    per worker process
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [make_rng(child) for child in seed.spawn(num)]
+
+
+def jumped_rng(seed, jumps):
+    """
+    stream of the given seed advanced by jumps*2^127 draws, jumps=0,1,2,...
+    give non-overlapping streams for consecutive shards of one long run
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return np.random.Generator(np.random.PCG64(seed).jumped(jumps))
+
+
+def _ratio(num, den):
+    """element-wise num/den, nan where den is 0"""
+    out = np.full(np.shape(num), np.nan)
+    np.divide(num, den, out=out, where=np.asarray(den) > 0)
+    return out
+
+
 class Simulator:
-    def __init__(self, n, full_info, seed, track_max=5, pass_max=5):
+    def __init__(self, n, full_info, seed, track_max=TRACK_MAX, pass_max=PASS_MAX,
+                 compile_policies=False, topology=None):
         """
         n: number of trollies in the simulation
         full_info: wether or not trollies have full information
                    see definition in proposal
-        seed: random seed
+        seed: random seed (int, SeedSequence or Generator), the simulator
+              draws everything from its own stream
         track_max: maximum possible number of people tied on one track
         pass_max: maximum possible number of passengers on a trolly
+        compile_policies: run deterministic agents through lookup tables,
+                          see agents_utils.CompiledAgent
+        topology: track layout, see topology_utils.Topology, a ring of n
+                  tracks by default
         """
         self.n = n
         self.full_info = full_info
         self.seed = seed
         self.track_max = track_max
         self.pass_max = pass_max
-
-        # random.seed(seed)
+        self.compile_policies = compile_policies
+        self.topology = Topology.ring(n) if topology is None else topology
+        if self.topology.n != n:
+            raise ValueError(f"topology has {self.topology.n} trollies, n={n}")
+        self.num_tracks = self.topology.num_tracks
+        # compiled agents by batch key of their source agents
+        self.compiled_agents = {}
+        # opt-in timers and counters, see enable_instrumentation
+        self.instrument = None
+        # opt-in trial recorder, see enable_trace
+        self.recorder = None
+        # opt-in per-agent selection stats, see enable_agent_stats
+        self.agent_stats = None
+
+        self.rng = make_rng(seed)
+        # smallest signed integer type holding every draw, sums are int64
+        self.draw_dtype = np.min_scalar_type(-max(track_max, pass_max))
         # random number of people tied to each track
-        self.track_nums = [random.randint(0, track_max) for i in range(n)]
-        self.trolly_pass_nums = [random.randint(0, pass_max) for i in range(n)]
-        # n trolly objects need to be manually set later with object calls
-        self.trollies = [None for i in range(n)]
+        self.track_nums = self.draw(self.num_tracks)
+        self.trolly_pass_nums = self.draw(track=False)
+        # type code of every trolly, the agents need to be manually set
+        # later with object calls or set_population
+        self.population = Population(n)
 
-        # accumulators for each trials
-        self.total_pass = 0  # total number of passengers
-        self.total_track = 0  # total number of people on the track
-        self.total_trials = 0  # total number of trials done so far
-        # total passengers & track people kileed by each trolly
-        self.trolly_kill_dict = [{"pass": 0, "track": 0} for i in range(n)] 
-
-        self.total_pass_kill = 0 # total number of passengers killed
-        self.total_track_kill = 0 # total number of people on the track killed
-        # total passengers & track people encountered by each trolly
-        # (include people from both tracks)
-        self.trolly_tot_dict = [{"pass": 0, "track": 0} for i in range(n)]
+        self.clear_records()
 
     def clear_records(self):
         # accumulators for each trials
@@ -55,13 +117,121 @@ class Simulator:
         self.total_track = 0  # total number of people on the track
         self.total_trials = 0  # total number of trials done so far
         # total passengers & track people kileed by each trolly
-        self.trolly_kill_dict = [{"pass": 0, "track": 0} for i in range(self.n)] 
+        self.trolly_pass_kills = np.zeros(self.n, dtype=np.int64)
+        self.trolly_track_kills = np.zeros(self.n, dtype=np.int64)
 
         self.total_pass_kill = 0  # total number of passengers killed
         self.total_track_kill = 0  # total number of people on the track killed
         # total passengers & track people encountered by each trolly
         # (include people from both tracks)
-        self.trolly_tot_dict = [{"pass": 0, "track": 0} for i in range(self.n)]
+        self.trolly_pass_tot = np.zeros(self.n, dtype=np.int64)
+        self.trolly_track_tot = np.zeros(self.n, dtype=np.int64)
+
+        # streaming statistics of the loss estimators (ratios of the kill and
+        # encounter totals, see get_tot_tele_loss), in total and by agent
+        # type label
+        self.tele_stats = RatioStats()
+        self.deon_stats = RatioStats()
+        self.type_stats = {}
+        if self.agent_stats is not None:
+            self.agent_stats.reset()
+
+    @property
+    def trolly_kill_dict(self):
+        """total passengers & track people killed by each trolly"""
+        return [{"pass": int(p), "track": int(t)} for p, t
+                in zip(self.trolly_pass_kills, self.trolly_track_kills)]
+
+    @property
+    def trolly_tot_dict(self):
+        """total passengers & track people encountered by each trolly"""
+        return [{"pass": int(p), "track": int(t)} for p, t
+                in zip(self.trolly_pass_tot, self.trolly_track_tot)]
+
+    def __getstate__(self):
+        # instrumentation and trace recording are not part of the state,
+        # compiled agents are keyed by batch keys that may be object ids and
+        # are recompiled on demand
+        state = self.__dict__.copy()
+        state.update(instrument=None, recorder=None, compiled_agents={})
+        return state
+
+    def checkpoint(self, path, **extra):
+        """
+        save the whole simulator state (population, current draws,
+        accumulators, streaming stats and RNG state) to path, a restored
+        simulator continues bit-identically
+        extra: additional picklable driver state saved with it
+        """
+        save_checkpoint(path, {"simulator": self, "extra": extra})
+
+    @classmethod
+    def restore(cls, path):
+        """return: (simulator, extra) saved by checkpoint"""
+        state = load_checkpoint(path)
+        return state["simulator"], state["extra"]
+
+    @property
+    def trollies(self):
+        """list view of the agent of every trolly"""
+        return self.population.agent_arr()
+
+    def draw(self, size=None, track=True):
+        """
+        draw the number of people on each track (track=True) or the number
+        of passengers on each trolly
+        size: shape of the draw, n by default
+        """
+        high = self.track_max+1 if track else self.pass_max+1
+        return self.rng.integers(0, high, size=self.n if size is None else size,
+                                 dtype=self.draw_dtype)
+
+    def enable_instrumentation(self):
+        """
+        start timing the phases of every trial and counting events
+        return: the Instrumentation collecting them
+        """
+        if self.instrument is None:
+            self.instrument = Instrumentation()
+        return self.instrument
+
+    def disable_instrumentation(self):
+        self.instrument = None
+
+    def enable_agent_stats(self, window=None, decay=None):
+        """
+        keep kill and encounter sums per agent (moved on shuffle, cleared
+        when a trolly is set) besides the per-slot ones, get_trolly_losses
+        and the selection use them from now on
+        window, decay: count only the last window rounds or decay the past
+                       rounds, see stats_utils.AgentStats and
+                       advance_agent_stats
+        return: the AgentStats
+        """
+        self.agent_stats = AgentStats(self.n, window=window, decay=decay)
+        return self.agent_stats
+
+    def disable_agent_stats(self):
+        self.agent_stats = None
+
+    def advance_agent_stats(self):
+        """end the current round of the per-agent stats"""
+        if self.agent_stats is not None:
+            self.agent_stats.advance()
+
+    def enable_trace(self, recorder):
+        """
+        record the draws and decisions of every trial from now on
+        recorder: trace_utils.TraceRecorder (or any object with
+                  record(track_nums, pass_nums, decisions) and close())
+        """
+        self.recorder = recorder
+
+    def disable_trace(self):
+        """stop recording and write the remaining trials of the trace"""
+        if self.recorder is not None:
+            self.recorder.close()
+        self.recorder = None
 
     def trolly_track_lookup(self, trolly_idx):
         """
@@ -70,149 +240,448 @@ class Simulator:
         """
         if trolly_idx < 0 or trolly_idx >= self.n:
             raise ValueError(f"trolly index out of bound, n={self.n}, trolly_idx={trolly_idx}")
-        
-        if trolly_idx == self.n-1:
-            return (trolly_idx, 0)
-        else:
-            return (trolly_idx, trolly_idx+1)
+        return self.topology.trolly_track_pair(trolly_idx)
 
     def trolly_neighbor_lookup(self, trolly_idx):
         """
         helper function that returns the 2 neighbor indices belong to the given
         indexed trolly
         (default_track_neighbor_idx, alternative_tracek_neighbor_idx)
+        off the ring a track can have no or several other contenders, the
+        neighbors are then arrays of trolly indices
         """
         if trolly_idx < 0 or trolly_idx >= self.n:
             raise ValueError(f"trolly index out of bound, n={self.n}, trolly_idx={trolly_idx}")
-        if trolly_idx == 0:
-            return (self.n-1, 1)
-        elif trolly_idx == self.n-1:
-            return (self.n-2, 0)
-        else:
-            return (trolly_idx-1, trolly_idx+1)
+        return self.topology.trolly_neighbors(trolly_idx)
+
+    def get_trolly_by_idx(self, idx):
+        return self.population.agent(idx)
 
     def get_trolly_str_by_idx(self, idx):
-        return str(self.trollies[idx])
+        return self.population.label(idx)
 
     def get_trolly_str_arr(self):
-        return [str(agent) for agent in self.trollies]
+        return self.population.label_arr()
 
     def set_trolly_by_idx(self, idx, trolly_obj):
         trolly_obj.set_pass_num(self.trolly_pass_nums[idx])
-        self.trollies[idx] = trolly_obj
+        self.population.set_agent(idx, trolly_obj)
+        if self.agent_stats is not None:
+            self.agent_stats.reset(idx)
 
     def batch_set_trollies(self, trolly_arr):
         assert len(trolly_arr) == self.n
         assert None not in trolly_arr
-        self.trollies = trolly_arr
+        self.population.set_agents(trolly_arr)
+        if self.agent_stats is not None:
+            self.agent_stats.reset()
+
+    def set_population(self, agent_types, codes):
+        """
+        set every trolly without creating one agent object per trolly
+        agent_types: agent of every type
+        codes: (n,) index into agent_types of every trolly
+        """
+        assert len(codes) == self.n
+        self.population = Population.from_codes(agent_types, codes)
+        if self.agent_stats is not None:
+            self.agent_stats.reset()
 
     def shuffle_trolly_arr(self):
-        random.shuffle(self.trollies)
+        order = self.rng.permutation(self.n)
+        self.population.permute(order)
+        if self.agent_stats is not None:
+            self.agent_stats.permute(order)
 
     def refresh_track_nums(self):
         """update the number of people on all the tracks """
-        self.track_nums = [random.randint(0, self.track_max) for i in range(self.n)]
+        if self.instrument is not None:
+            start = time.perf_counter()
+        self.track_nums = self.draw(self.num_tracks)
+        if self.instrument is not None:
+            self.instrument.lap("draw", start)
+            self.instrument.count("draws", self.num_tracks)
 
     def refresh_pass_nums(self):
         """update the number of people on all the tracks """
-        self.trolly_pass_nums = [random.randint(0, self.pass_max) for i in range(self.n)]
+        if self.instrument is not None:
+            start = time.perf_counter()
+        self.trolly_pass_nums = self.draw(track=False)
+        if self.instrument is not None:
+            self.instrument.lap("draw", start)
+            self.instrument.count("draws", self.n)
 
     def get_tot_tele_loss(self):
-        return (self.total_pass_kill + self.total_track_kill) / (self.total_pass + self.total_track)
+        """nan before anyone was encountered (e.g. after 0 trials)"""
+        return float(_ratio(self.total_pass_kill + self.total_track_kill,
+                            self.total_pass + self.total_track))
 
     def get_tot_deon_loss(self):
-        return (self.total_pass_kill) / (self.total_pass)
+        return float(_ratio(self.total_pass_kill, self.total_pass))
 
-    def get_tele_loss_by_idx(self, idx_arr):
-        tot_kills = 0
-        tot_ecounter = 0
-        for i in idx_arr:
-            tot_kills += self.trolly_kill_dict[i]['pass']
-            tot_kills += self.trolly_kill_dict[i]['track']
-            tot_ecounter += self.trolly_tot_dict[i]['pass']
-            tot_ecounter += self.trolly_tot_dict[i]['track']
+    def _as_index(self, idx_arr):
+        """turn a list/array of trolly indices or a boolean mask into an index"""
+        idx_arr = np.asarray(idx_arr)
+        if idx_arr.dtype != bool:
+            idx_arr = idx_arr.astype(np.intp)
+        return idx_arr
 
-        return tot_kills/tot_ecounter
+    def get_tele_loss_by_idx(self, idx_arr):
+        """
+        idx_arr: trolly indices or boolean mask of length n
+        return: teleology loss of the selected trollies, nan if they haven't
+                encountered anyone yet
+        """
+        idx_arr = self._as_index(idx_arr)
+        tot_kills = self.trolly_pass_kills[idx_arr].sum() \
+            + self.trolly_track_kills[idx_arr].sum()
+        tot_ecounter = self.trolly_pass_tot[idx_arr].sum() \
+            + self.trolly_track_tot[idx_arr].sum()
+        if tot_ecounter == 0:
+            return float("nan")
+        return float(tot_kills/tot_ecounter)
 
     def get_deon_loss_by_idx(self, idx_arr):
-        tot_pass_kills = 0
-        tot_pass_ecounter = 0
-        for i in idx_arr:
-            tot_pass_kills += self.trolly_kill_dict[i]['pass']
-            tot_pass_ecounter += self.trolly_tot_dict[i]['pass']
-
-        return tot_pass_kills/tot_pass_ecounter
+        """
+        idx_arr: trolly indices or boolean mask of length n
+        return: deontology loss of the selected trollies, nan if they haven't
+                carried any passenger yet
+        """
+        idx_arr = self._as_index(idx_arr)
+        tot_pass_kills = self.trolly_pass_kills[idx_arr].sum()
+        tot_pass_ecounter = self.trolly_pass_tot[idx_arr].sum()
+        if tot_pass_ecounter == 0:
+            return float("nan")
+        return float(tot_pass_kills/tot_pass_ecounter)
+
+    def get_trolly_losses(self, loss_type):
+        """
+        loss_type: currently either teleology loss or deontology loss
+        return: array of the loss of every trolly, nan for the trollies
+                that haven't encountered anyone yet, from the per-agent
+                stats if enabled (see enable_agent_stats)
+        """
+        if not isinstance(loss_type, LossType):
+            raise TypeError('loss type must be an instance of LossType')
+        if self.agent_stats is not None:
+            pass_kills, track_kills, pass_tot, track_tot = self.agent_stats.totals
+        else:
+            pass_kills, track_kills = self.trolly_pass_kills, self.trolly_track_kills
+            pass_tot, track_tot = self.trolly_pass_tot, self.trolly_track_tot
+        if loss_type == LossType.TELE:
+            kills = pass_kills + track_kills
+            ecounter = pass_tot + track_tot
+        elif loss_type == LossType.DEON:
+            kills = pass_kills
+            ecounter = pass_tot
+        losses = np.full(self.n, np.nan)
+        np.divide(kills, ecounter, out=losses, where=ecounter > 0)
+        return losses
 
     def get_top_bot_n_trolly_idx(self, n, loss_type):
         """
         n: number of returned top idices\n
         loss_type: currently either teleology loss or deontology loss\n
-        reverse: False - top n lowest loss; True - top n highest loss\n
+        return: (top n lowest loss, top n highest loss) trolly indices, each
+                sorted from the most extreme loss, trollies that haven't
+                encountered anyone yet are picked last on both ends\n
         """
-        if not isinstance(loss_type, LossType):
-            raise TypeError('loss type must be an instance of LossType')
         assert n <= self.n
-        loss_arr = []
-        for i in range(len(self.trollies)):
-            if loss_type == LossType.TELE:
-                loss = self.get_tele_loss_by_idx([i])
-            elif loss_type == LossType.DEON:
-                loss = self.get_deon_loss_by_idx([i])
-            loss_arr.append(loss)
-        sort_idx = np.argsort(loss_arr)
-        top_n = sort_idx[:n]
-        bot_n = sort_idx[::-1][:n]
+        loss_arr = self.get_trolly_losses(loss_type)
+        if n == 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+        # partial selection of the n extreme losses, then sort only those
+        top_key = np.where(np.isnan(loss_arr), np.inf, loss_arr)
+        top_n = np.argpartition(top_key, n-1)[:n]
+        top_n = top_n[np.argsort(top_key[top_n], kind="stable")]
+        bot_key = np.where(np.isnan(loss_arr), np.inf, -loss_arr)
+        bot_n = np.argpartition(bot_key, n-1)[:n]
+        bot_n = bot_n[np.argsort(bot_key[bot_n], kind="stable")]
         return top_n, bot_n
 
 
-    def run_trial(self):
-        track_chosen_arr = []
-        self.total_trials += 1
-        self.total_pass += sum(self.trolly_pass_nums)
-        self.total_track += sum(self.track_nums)
-        for idx, trolly in enumerate(self.trollies):
-            # update passanger number
-            trolly.set_pass_num(self.trolly_pass_nums[idx])
-            (def_idx, alt_idx) = self.trolly_track_lookup(idx)
-            trolly.set_track_nums(def_num=self.track_nums[def_idx], \
-                                  alt_num=self.track_nums[alt_idx])
-            if self.full_info:
-                (def_neigh_idx, alt_neigh_idx) = self.trolly_neighbor_lookup(idx)
-                def_neigh_pass_num = self.trolly_pass_nums[def_neigh_idx]
-                alt_neigh_pass_num = self.trolly_pass_nums[alt_neigh_idx]
-            else:
-                def_neigh_pass_num = None
-                alt_neigh_pass_num = None
-
-            self.trolly_tot_dict[idx]["pass"] += trolly.get_pass_num()
-            self.trolly_tot_dict[idx]["track"] += sum(trolly.get_track_nums())
-
-            decision = trolly.make_decision(def_neigh_pass_num, alt_neigh_pass_num)
-            track_chosen_arr.append(self.trolly_track_lookup(idx)[decision])
-
-        # record kill stats for individual trolly
-        for i, track_idx in enumerate(track_chosen_arr):
-            trolly_idx = [i for i, e in enumerate(track_chosen_arr) if e == track_idx]
-            assert len(trolly_idx) == 1 or len(trolly_idx) == 2
-            assert i == trolly_idx[0] or i == trolly_idx[1]
-            if len(trolly_idx) == 2:
-                self.trolly_kill_dict[i]["pass"] += self.trolly_pass_nums[i]
-            self.trolly_kill_dict[i]['track'] += self.track_nums[track_idx]
-
-        # record total kill stats
-        for i, track_idx in enumerate(set(track_chosen_arr)):
-            trolly_idx = [i for i, e in enumerate(track_chosen_arr) if e == track_idx]
-            assert len(trolly_idx) == 1 or len(trolly_idx) == 2
-            if len(trolly_idx) == 2:
-                self.total_pass_kill += ((self.trolly_pass_nums[trolly_idx[0]] \
-                    + self.trolly_pass_nums[trolly_idx[1]]))
-            self.total_track_kill += self.track_nums[track_idx]
-        # print(track_chosen_arr)
-        # print(self.total_pass_kill, self.total_track_kill)
-        # print(self.total_trials, self.total_pass, self.total_track)
-        # print(self.trolly_kill_dict)
-        # print(self.trolly_tot_dict)
-        return self.trolly_kill_dict
+    def run_trials(self, k):
+        """
+        batched version of run_trial, draws the track and passenger numbers
+        of k trials as (k, n) arrays and resolves every decision, collision
+        and kill with array operations
+        updates the same accumulators as k rounds of refresh_track_nums,
+        refresh_pass_nums and run_trial
+        k: number of trials to run
+        return: (trolly_pass_kills, trolly_track_kills) arrays of the total
+                kills of each trolly, see trolly_kill_dict for the dict view
+        """
+        if k == 0:
+            return self.trolly_pass_kills, self.trolly_track_kills
+        if self.instrument is not None:
+            start = time.perf_counter()
+        track_nums = self.draw((k, self.num_tracks))
+        pass_nums = self.draw((k, self.n), track=False)
+        if self.instrument is not None:
+            self.instrument.lap("draw", start)
+            self.instrument.count("draws", k * (self.num_tracks + self.n))
+
+        decisions = self.decide_trials(track_nums, pass_nums)
+        self.record_trials(track_nums, pass_nums, decisions)
+        # keep the last drawn trial as the current state of the simulator
+        self.track_nums = track_nums[-1]
+        self.trolly_pass_nums = pass_nums[-1]
+        return self.trolly_pass_kills, self.trolly_track_kills
+
+    def group_trollies(self):
+        """
+        group the trollies by their type (batch key)
+        return: list of (agent, trolly indices) pairs, decide_batch of the
+                agent decides for every trolly in the group
+        """
+        assert self.population.is_full(), "every trolly needs to be set"
+        groups = []
+        for code, idx in self.population.groups():
+            agent = self.population.types[code]
+            if self.compile_policies:
+                agent = self.compile_agent(agent.batch_key(), agent)
+            groups.append((agent, idx))
+        return groups
+
+    def compile_agent(self, key, agent):
+        """
+        lookup table version of a deterministic agent, compiled once per key,
+        the agent itself if its table is too large (see agents_utils.MAX_TABLE_CELLS)
+        """
+        if not agent.deterministic:
+            return agent
+        if key not in self.compiled_agents:
+            self.compiled_agents[key] = agent.compile(self.full_info)
+        return self.compiled_agents[key]
 
+    def trial_inputs(self, track_nums, pass_nums):
+        """
+        return: list of the (k, n) decide_batch inputs of every trolly,
+                pass_nums, def_track_nums, alt_track_nums and with full
+                information def_neigh_pass_nums, alt_neigh_pass_nums
+        """
+        inputs = [pass_nums, *self.topology.trolly_track_nums(track_nums)]
+        if self.full_info:
+            inputs += self.topology.neighbor_pass_nums(pass_nums)
+        return inputs
 
+    def decide_trials(self, track_nums, pass_nums):
+        """
+        make the decisions of every trolly for a batch of trials with one
+        decide_batch call per group of trollies
+        track_nums: (k, num_tracks) number of people on each track
+        pass_nums: (k, n) number of passengers on each trolly
+        return: (k, n) decision made by each trolly (0 - stay, 1 - switch)
+        """
+        if self.instrument is not None:
+            start = time.perf_counter()
+        k = track_nums.shape[0]
+        inputs = self.trial_inputs(track_nums, pass_nums)
+
+        decisions = np.empty((k, self.n), dtype=np.int8)
+        for agent, idx in self.group_trollies():
+            group_decisions = agent.decide_batch(*[arr[:, idx].ravel()
+                                                   for arr in inputs])
+            decisions[:, idx] = np.reshape(group_decisions, (k, len(idx)))
+            if self.instrument is not None:
+                self.instrument.count(f"decisions:{agent}", k * len(idx))
+        if self.instrument is not None:
+            self.instrument.lap("decide", start)
+        return decisions
+
+    def record_trials(self, track_nums, pass_nums, decisions):
+        """
+        resolve collisions and update all the accumulators for a batch of
+        trials
+        track_nums: (k, num_tracks) number of people on each track
+        pass_nums: (k, n) number of passengers on each trolly
+        decisions: (k, n) decision made by each trolly (0 - stay, 1 - switch)
+        return: (tele, deon) (k,) loss of every trial, see record_loss_samples
+        """
+        if self.recorder is not None:
+            self.recorder.record(track_nums, pass_nums, decisions)
+        if self.instrument is not None:
+            start = time.perf_counter()
+        k = decisions.shape[0]
+        pass_kills, track_kills, occupancy = \
+            self.topology.outcome(track_nums, pass_nums, decisions)
+        if self.instrument is not None:
+            start = self.instrument.lap("collide", start)
+            self.instrument.count("collisions", int(np.count_nonzero(occupancy > 1)))
+            self.instrument.count("trials", k)
+
+        self.total_trials += k
+        self.total_pass += int(pass_nums.sum())
+        self.total_track += int(track_nums.sum())
+        self.total_pass_kill += int(pass_kills.sum())
+        self.total_track_kill += int(track_nums[occupancy > 0].sum())
+
+        def_track_nums, alt_track_nums = self.topology.trolly_track_nums(track_nums)
+        self.accumulate_trollies(pass_kills.sum(axis=0), track_kills.sum(axis=0),
+                                 pass_nums.sum(axis=0),
+                                 def_track_nums.sum(axis=0) + alt_track_nums.sum(axis=0))
+        if self.instrument is not None:
+            start = self.instrument.lap("account", start)
+        if any(agent.learning for agent in self.population.types):
+            self.learn_trials(track_nums, pass_nums, decisions, pass_kills,
+                              track_kills)
+            if self.instrument is not None:
+                start = self.instrument.lap("learn", start)
+
+        trial_losses = self.record_loss_samples(track_nums, pass_nums, pass_kills,
+                                                track_kills, occupancy)
+        if self.instrument is not None:
+            self.instrument.lap("stats", start)
+        return trial_losses
+
+    def accumulate_trollies(self, pass_kills, track_kills, pass_tot, track_tot):
+        """
+        add the (n,) kill and encounter sums of a batch of trials to the
+        per-slot accumulators and the per-agent stats
+        """
+        self.trolly_pass_kills += pass_kills
+        self.trolly_track_kills += track_kills
+        self.trolly_pass_tot += pass_tot
+        self.trolly_track_tot += track_tot
+        if self.agent_stats is not None:
+            self.agent_stats.add(np.stack([pass_kills, track_kills, pass_tot,
+                                           track_tot]))
+
+    def learn_trials(self, track_nums, pass_nums, decisions, pass_kills,
+                     track_kills):
+        """
+        let every learning agent type update its policy on the outcome of a
+        batch of trials, with one update_batch call per group of trollies
+        pass_kills, track_kills: (k, n) kills of each trolly
+        """
+        inputs = self.trial_inputs(track_nums, pass_nums)
+        if not self.full_info:
+            inputs += [None, None]
+        for agent, idx in self.group_trollies():
+            if not agent.learning:
+                continue
+            agent.update_batch(*[arr if arr is None else arr[:, idx].ravel()
+                                 for arr in inputs + [decisions, pass_kills,
+                                                      track_kills]])
+
+    def record_loss_samples(self, track_nums, pass_nums, pass_kills,
+                            track_kills, occupancy):
+        """
+        fold the loss of every trial of a batch into the streaming stats,
+        in total and by agent type
+        pass_kills, track_kills: (k, n) kills of each trolly
+        occupancy: (k, num_tracks) number of trollies on each track
+        return: (tele, deon) (k,) loss of every trial, nan for the trials
+                without anyone (passengers for deon) to kill
+        """
+        trial_pass_kill = pass_kills.sum(axis=1)
+        trial_sums = {"pass_kill": trial_pass_kill,
+                      "kill": trial_pass_kill + (track_nums * (occupancy > 0)).sum(axis=1),
+                      "pass": pass_nums.sum(axis=1),
+                      "track": track_nums.sum(axis=1)}
+        # the draws are compact ints, upcast before adding them up
+        trolly_kills = pass_kills.astype(np.int64) + track_kills
+        def_track_nums, alt_track_nums = self.topology.trolly_track_nums(track_nums)
+        trolly_ecounter = pass_nums.astype(np.int64) + def_track_nums + alt_track_nums
+        label_sums = {label: (trolly_kills[:, mask].sum(axis=1),
+                              trolly_ecounter[:, mask].sum(axis=1),
+                              pass_kills[:, mask].sum(axis=1),
+                              pass_nums[:, mask].sum(axis=1))
+                      for label, mask in self.population.label_masks().items()}
+        return self.fold_loss_samples(trial_sums, label_sums)
+
+    def fold_loss_samples(self, trial_sums, label_sums):
+        """
+        trial_sums: {"pass_kill", "kill", "pass", "track"} (k,) totals of
+                    every trial
+        label_sums: {label: (kills, encounters, passenger kills, passengers)}
+                    (k,) totals of the trollies of every agent type
+        return: (tele, deon) (k,) loss of every trial
+        """
+        trial_ecounter = trial_sums["pass"] + trial_sums["track"]
+        self.tele_stats.update(trial_sums["kill"], trial_ecounter)
+        self.deon_stats.update(trial_sums["pass_kill"], trial_sums["pass"])
+        for label, (kills, ecounter, pass_kills, pass_nums) in label_sums.items():
+            if label not in self.type_stats:
+                self.type_stats[label] = {"tele": RatioStats(),
+                                          "deon": RatioStats()}
+            self.type_stats[label]["tele"].update(kills, ecounter)
+            self.type_stats[label]["deon"].update(pass_kills, pass_nums)
+        return (_ratio(trial_sums["kill"], trial_ecounter),
+                _ratio(trial_sums["pass_kill"], trial_sums["pass"]))
+
+    def get_ci_halfwidths(self, by_type=False):
+        """
+        by_type: also include the stats of every agent type
+        return: {"tele": ci half width, "deon": ci half width} of the
+                reported losses (get_tot_tele_loss, get_tele_loss_by_idx...),
+                with an extra {label: {...}} entry under "types" if by_type
+        """
+        halfwidths = {"tele": self.tele_stats.get_ci_halfwidth(),
+                      "deon": self.deon_stats.get_ci_halfwidth()}
+        if by_type:
+            halfwidths["types"] = {
+                label: {key: stats.get_ci_halfwidth()
+                        for key, stats in label_stats.items()}
+                for label, label_stats in self.type_stats.items()}
+        return halfwidths
+
+    def run_until(self, ci_halfwidth, max_trials, batch_size=100,
+                  by_type=False):
+        """
+        run batches of trials until the confidence intervals of the tele
+        and deon losses are narrow enough
+        ci_halfwidth: requested 95% confidence interval half width
+        max_trials: maximum number of trials to run in this call
+        batch_size: number of trials between two precision checks
+        by_type: also require the precision for every agent type
+        return: number of trials run
+        """
+        num_trials = 0
+        while num_trials < max_trials:
+            k = min(batch_size, max_trials - num_trials)
+            self.run_trials(k)
+            num_trials += k
+            halfwidths = self.get_ci_halfwidths(by_type)
+            widths = [halfwidths["tele"], halfwidths["deon"]]
+            for label_widths in halfwidths.get("types", {}).values():
+                widths += list(label_widths.values())
+            # nan widths (not enough samples yet) fail the comparison
+            if all(width <= ci_halfwidth for width in widths):
+                break
+        return num_trials
+
+    def run_scenarios(self, bank, batch_size=None, start=0, stop=None):
+        """
+        run the trials of a scenario bank instead of drawing them, so other
+        simulators run against the same bank face the same trials (common
+        random numbers), the simulator's own stream isn't used
+        bank: scenario_utils.ScenarioBank drawn for this layout
+        batch_size: number of trials decided at once
+        start, stop: range of scenarios to run, the whole bank by default
+        return: {"tele": (#trials,), "deon": (#trials,)} loss of every trial
+        """
+        if (bank.n, bank.num_tracks, bank.track_max, bank.pass_max) != \
+                (self.n, self.num_tracks, self.track_max, self.pass_max):
+            raise ValueError("scenario bank doesn't match the simulator")
+        trial_losses = {"tele": [], "deon": []}
+        for track_nums, pass_nums in bank.iter_batches(batch_size, start, stop):
+            tele, deon = self.record_trials(
+                track_nums, pass_nums, self.decide_trials(track_nums, pass_nums))
+            trial_losses["tele"].append(tele)
+            trial_losses["deon"].append(deon)
+            self.track_nums = track_nums[-1]
+            self.trolly_pass_nums = pass_nums[-1]
+        return {key: np.concatenate(arrs) if arrs else np.empty(0)
+                for key, arrs in trial_losses.items()}
 
+    def run_trial(self):
+        """
+        run one trial on the current draws
+        return: (trolly_pass_kills, trolly_track_kills), see run_trials
+        """
+        track_nums = np.array([self.track_nums])
+        pass_nums = np.array([self.trolly_pass_nums])
+        self.record_trials(track_nums, pass_nums,
+                           self.decide_trials(track_nums, pass_nums))
+        return self.trolly_pass_kills, self.trolly_track_kills
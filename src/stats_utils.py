@@ -0,0 +1,208 @@
+"""
+Utilities for streaming statistics of simulation results
+"""
+import numpy as np
+
+
+class RunningStats:
+    """
+    streaming mean and variance (Welford), batches are folded in with the
+    parallel update of Chan et al. so no sample needs to be kept
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0  # sum of squared differences from the mean
+
+    def update(self, samples):
+        """fold a batch of samples in, nan samples are ignored"""
+        samples = np.asarray(samples, dtype=float).ravel()
+        samples = samples[~np.isnan(samples)]
+        if len(samples) == 0:
+            return
+        batch_count = len(samples)
+        batch_mean = samples.mean()
+        batch_M2 = np.sum((samples - batch_mean)**2)
+
+        count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_count / count
+        self.M2 += batch_M2 + delta**2 * self.count * batch_count / count
+        self.count = count
+
+    def get_var(self):
+        """unbiased sample variance, nan with less than 2 samples"""
+        if self.count < 2:
+            return float("nan")
+        return self.M2 / (self.count - 1)
+
+    def get_std_err(self):
+        return float(np.sqrt(self.get_var() / self.count)) if self.count else float("nan")
+
+    def get_ci_halfwidth(self, z=1.96):
+        """half width of the normal confidence interval of the mean"""
+        return z * self.get_std_err()
+
+
+
+class RatioStats:
+    """
+    streaming ratio of totals sum(nums) / sum(dens) of per-trial numerators
+    and denominators, with the delta method variance of that ratio
+    estimator, batches are folded in with the parallel update of the means
+    and (co-)moments like RunningStats
+    """
+    def __init__(self):
+        self.count = 0
+        self.num_mean = 0.0
+        self.den_mean = 0.0
+        self.num_M2 = 0.0
+        self.den_M2 = 0.0
+        self.co_M2 = 0.0  # sum of products of the differences from the means
+
+    def update(self, nums, dens):
+        """fold a batch of (numerator, denominator) trials in"""
+        nums = np.asarray(nums, dtype=float).ravel()
+        dens = np.asarray(dens, dtype=float).ravel()
+        if len(nums) == 0:
+            return
+        batch_count = len(nums)
+        batch_num_mean = nums.mean()
+        batch_den_mean = dens.mean()
+        num_diff = nums - batch_num_mean
+        den_diff = dens - batch_den_mean
+
+        count = self.count + batch_count
+        num_delta = batch_num_mean - self.num_mean
+        den_delta = batch_den_mean - self.den_mean
+        weight = self.count * batch_count / count
+        self.num_M2 += num_diff @ num_diff + num_delta**2 * weight
+        self.den_M2 += den_diff @ den_diff + den_delta**2 * weight
+        self.co_M2 += num_diff @ den_diff + num_delta * den_delta * weight
+        self.num_mean += num_delta * batch_count / count
+        self.den_mean += den_delta * batch_count / count
+        self.count = count
+
+    @property
+    def mean(self):
+        """ratio of the totals, nan before any denominator"""
+        if not self.den_mean > 0:
+            return float("nan")
+        return self.num_mean / self.den_mean
+
+    def get_std_err(self):
+        """
+        delta method standard error of the ratio, the std of the residuals
+        num - ratio*den over sqrt(count) * mean den, nan with less than 2
+        trials
+        """
+        if self.count < 2 or not self.den_mean > 0:
+            return float("nan")
+        ratio = self.mean
+        resid_var = (self.num_M2 - 2*ratio*self.co_M2 + ratio**2*self.den_M2) \
+            / (self.count - 1)
+        return float(np.sqrt(max(resid_var, 0.0) / self.count) / self.den_mean)
+
+    def get_ci_halfwidth(self, z=1.96):
+        """half width of the normal confidence interval of the ratio"""
+        return z * self.get_std_err()
+
+def paired_difference(samples_a, samples_b, z=1.96):
+    """
+    compare two sets of per-trial samples drawn on the same scenarios (common
+    random numbers), trials where either sample is nan are dropped
+    return: {"mean": mean of a - b, "ci_halfwidth": normal confidence
+            interval half width of the paired difference,
+            "unpaired_ci_halfwidth": the half width independent runs with
+            the same number of trials would give}
+    """
+    samples_a = np.asarray(samples_a, dtype=float)
+    samples_b = np.asarray(samples_b, dtype=float)
+    valid = ~(np.isnan(samples_a) | np.isnan(samples_b))
+    samples_a = samples_a[valid]
+    samples_b = samples_b[valid]
+    count = len(samples_a)
+    if count < 2:
+        nan = float("nan")
+        return {"mean": nan, "ci_halfwidth": nan, "unpaired_ci_halfwidth": nan}
+    diff = samples_a - samples_b
+    unpaired_var = samples_a.var(ddof=1) + samples_b.var(ddof=1)
+    return {"mean": float(diff.mean()),
+            "ci_halfwidth": float(z * np.sqrt(diff.var(ddof=1) / count)),
+            "unpaired_ci_halfwidth": float(z * np.sqrt(unpaired_var / count))}
+
+
+class AgentStats:
+    """
+    kill and encounter sums of every agent of a population, kept with the
+    agent rather than its slot: permute moves them along when the agents
+    are shuffled and reset clears the slot of a replaced agent
+    window: only count the last window rounds, kept as a ring buffer of
+            per-round sums
+    decay: weight the sums of every past round down by this factor instead
+           (exponentially decayed), at most one of window and decay
+    without either the sums run since the agent took its slot
+    """
+    FIELDS = ["pass_kills", "track_kills", "pass_tot", "track_tot"]
+
+    def __init__(self, shape, window=None, decay=None):
+        """
+        shape: shape of the slots, (n,) or (#replicates, n)
+        """
+        if window is not None and decay is not None:
+            raise ValueError("set at most one of window and decay")
+        if window is not None and window < 1:
+            raise ValueError(f"window must be at least 1 round, got {window}")
+        if decay is not None and not 0 < decay < 1:
+            raise ValueError(f"decay must be in (0, 1), got {decay}")
+        self.window = window
+        self.decay = decay
+        shape = (len(self.FIELDS),) + tuple(np.atleast_1d(shape))
+        # sums over the window / decayed sums of every slot, in FIELDS order
+        self.totals = np.zeros(shape, dtype=float if decay is not None else np.int64)
+        # per-round sums of the window, self.pos is the current round
+        self.rounds = None if window is None else \
+            np.zeros((window,) + shape, dtype=np.int64)
+        self.pos = 0
+
+    def __getitem__(self, field):
+        return self.totals[self.FIELDS.index(field)]
+
+    def add(self, sums):
+        """
+        sums: (len(FIELDS), *shape) sums of a batch of trials of every slot
+        """
+        self.totals += sums
+        if self.rounds is not None:
+            self.rounds[self.pos] += sums
+
+    def advance(self):
+        """end the current round"""
+        if self.rounds is not None:
+            # the oldest round of the window leaves it
+            self.pos = (self.pos + 1) % self.window
+            self.totals -= self.rounds[self.pos]
+            self.rounds[self.pos] = 0
+        elif self.decay is not None:
+            self.totals *= self.decay
+
+    def reset(self, idx=None):
+        """
+        idx: slot index or boolean mask of the slots to clear, every slot
+             if None
+        """
+        idx = slice(None) if idx is None else idx
+        self.totals[:, idx] = 0
+        if self.rounds is not None:
+            self.rounds[:, :, idx] = 0
+
+    def permute(self, order):
+        """
+        order: new slot order like the agents, slot i gets the stats of
+               slot order[..., i]
+        """
+        self.totals = np.take_along_axis(
+            self.totals, np.broadcast_to(order, self.totals.shape), axis=-1)
+        if self.rounds is not None:
+            self.rounds = np.take_along_axis(
+                self.rounds, np.broadcast_to(order, self.rounds.shape), axis=-1)
@@ -0,0 +1,36 @@
+"""
+Utilities for running independent experiment cells on a process pool
+"""
+from collections import namedtuple
+
+
+# one independent unit of work of an experiment sweep
+# exp: experiment name, n: number of trollies,
+# mode: full_info or loss type, params: tuple of extra (key, value) pairs
+Cell = namedtuple("Cell", ["exp", "n", "mode", "params"])
+
+
+def make_cell(exp, n, mode, **params):
+    return Cell(exp, n, mode, tuple(sorted(params.items())))
+
+
+def run_sweep(cell_fn, cells, num_workers=None):
+    """
+    cell_fn: picklable function taking a cell and returning its result
+    cells: list of cells, each cell must seed its own randomness so the
+           results don't depend on which process runs it
+    num_workers: number of worker processes (None - one per cpu),
+                 1 runs every cell in the current process
+    return: {cell: result}
+    """
+    # hand out the largest cells first so they don't end up last on a worker
+    order = sorted(range(len(cells)), key=lambda i: cells[i].n, reverse=True)
+    ordered_cells = [cells[i] for i in order]
+    if num_workers == 1:
+        results = [cell_fn(cell) for cell in ordered_cells]
+    else:
+        # imported here, most runs of main.py never start a pool
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(cell_fn, ordered_cells))
+    return dict(zip(ordered_cells, results))
@@ -0,0 +1,226 @@
+"""
+Utilities for the track layout of the trolly simulation
+
+Every trolly chooses between its default track (stay) and its alternative
+track (switch), trollies choosing the same track collide. The layout is kept
+as index arrays: trolly_tracks (n, 2) maps each trolly to its 2 candidate
+tracks and the CSR pair (track_ptr, track_trollies) lists the trollies
+contending for each track, so every lookup is a gather and collisions are
+resolved in time linear in the number of (trolly, track) edges. The ring
+derives all of it from the trolly index and keeps no index array.
+"""
+from functools import cached_property
+import numpy as np
+
+
+def ring_outcome(track_nums, pass_nums, decisions):
+    """
+    resolve the collisions of a batch of trials on a ring
+    track_nums: (..., n) number of people on each track
+    pass_nums: (..., n) number of passengers on each trolly
+    decisions: (..., n) decision made by each trolly (0 - stay, 1 - switch)
+    return: (pass_kills, track_kills, occupancy) (..., n) arrays of the
+            passengers and track people killed by each trolly and the number
+            of trollies on each track
+    """
+    # track j can only be taken by trolly j staying or trolly j-1 switching
+    # (see Topology.ring), so its occupancy count is local
+    stay = decisions == 0
+    switch_in = ~np.roll(stay, 1, axis=-1)
+    occupancy = stay.astype(np.int8) + switch_in
+    # a staying trolly collides with the one switching in, a switching
+    # trolly with the next one staying
+    collided = np.where(stay, switch_in, np.roll(stay, -1, axis=-1))
+    pass_kills = np.where(collided, pass_nums, 0)
+    track_kills = np.where(stay, track_nums, np.roll(track_nums, -1, axis=-1))
+    return pass_kills, track_kills, occupancy
+
+
+class Topology:
+    # the CSR adjacency, built on first use (the ring fast path never reads
+    # it), see build_csr
+    CSR_FIELDS = ("track_trollies", "track_ptr", "edge_tracks", "used_tracks",
+                  "used_starts")
+
+    def __init__(self, trolly_tracks, num_tracks=None, is_ring=False):
+        """
+        trolly_tracks: (n, 2) (default track, alternative track) of every
+                       trolly, the 2 tracks of a trolly must differ, None on
+                       a ring (n = num_tracks)
+        num_tracks: number of tracks, 1 + the largest track index by default
+        is_ring: trolly i runs on tracks (i, i+1 mod n), collisions are then
+                 resolved with the ring_outcome fast path and no index array
+                 is kept
+        """
+        if trolly_tracks is None:
+            if not is_ring or num_tracks is None:
+                raise ValueError("trolly_tracks can only be left out on a ring of num_tracks")
+            self.n = num_tracks
+        else:
+            trolly_tracks = np.asarray(trolly_tracks, dtype=np.intp)
+            if trolly_tracks.ndim != 2 or trolly_tracks.shape[1] != 2:
+                raise ValueError(f"trolly_tracks must be (n, 2), got {trolly_tracks.shape}")
+            if num_tracks is None:
+                num_tracks = int(trolly_tracks.max()) + 1
+            if trolly_tracks.min() < 0 or trolly_tracks.max() >= num_tracks:
+                raise ValueError(f"track indices out of bound, num_tracks={num_tracks}")
+            if not is_ring and np.any(trolly_tracks[:, 0] == trolly_tracks[:, 1]):
+                raise ValueError("default and alternative track of a trolly must differ")
+            self.n = len(trolly_tracks)
+            self.trolly_tracks = trolly_tracks
+        self.num_tracks = num_tracks
+        self.is_ring = is_ring
+
+    @cached_property
+    def trolly_tracks(self):
+        """(n, 2) (default track, alternative track) of every trolly"""
+        trolly_idx = np.arange(self.n)
+        return np.stack([trolly_idx, (trolly_idx+1) % self.n], axis=1)
+
+    @property
+    def def_tracks(self):
+        return self.trolly_tracks[:, 0]
+
+    @property
+    def alt_tracks(self):
+        return self.trolly_tracks[:, 1]
+
+    def build_csr(self):
+        """
+        CSR adjacency, the contenders of track t are
+        track_trollies[track_ptr[t]:track_ptr[t+1]]
+        """
+        edge_tracks = self.trolly_tracks.ravel()
+        order = np.argsort(edge_tracks, kind="stable")
+        self.track_trollies = order // 2
+        self.track_ptr = np.zeros(self.num_tracks+1, dtype=np.intp)
+        np.cumsum(np.bincount(edge_tracks, minlength=self.num_tracks),
+                  out=self.track_ptr[1:])
+        self.edge_tracks = edge_tracks[order]
+        # tracks with at least one contender and the start of their edges
+        self.used_tracks = np.flatnonzero(np.diff(self.track_ptr))
+        self.used_starts = self.track_ptr[self.used_tracks]
+
+    def __getattr__(self, name):
+        # only called for missing attributes
+        if name in Topology.CSR_FIELDS:
+            self.build_csr()
+            return self.__dict__[name]
+        raise AttributeError(f"{type(self).__name__} has no attribute {name}")
+
+    @classmethod
+    def ring(cls, n):
+        """the default layout, n trollies on a ring of n tracks"""
+        return cls(None, n, is_ring=True)
+
+    @classmethod
+    def line(cls, n):
+        """open line of n+1 tracks, the first and last trolly have no neighbor"""
+        trolly_idx = np.arange(n)
+        return cls(np.stack([trolly_idx, trolly_idx+1], axis=1), n+1)
+
+    @classmethod
+    def switch_yard(cls, n, fan_in):
+        """
+        every trolly has a track of its own and shares its alternative track
+        with fan_in-1 other trollies (ceil(n/fan_in) shared tracks)
+        """
+        trolly_idx = np.arange(n)
+        return cls(np.stack([trolly_idx, n + trolly_idx//fan_in], axis=1),
+                   n + -(-n // fan_in))
+
+    @classmethod
+    def random_graph(cls, n, num_tracks, seed=0):
+        """every trolly picks 2 distinct tracks uniformly out of num_tracks"""
+        if num_tracks < 2:
+            raise ValueError(f"random graph needs at least 2 tracks, got {num_tracks}")
+        rng = np.random.default_rng(seed)
+        def_tracks = rng.integers(0, num_tracks, size=n)
+        # shift by 1..num_tracks-1 so the alternative track always differs
+        alt_tracks = (def_tracks + rng.integers(1, num_tracks, size=n)) % num_tracks
+        return cls(np.stack([def_tracks, alt_tracks], axis=1), num_tracks)
+
+    def trolly_track_pair(self, trolly_idx):
+        """return: (default track, alternative track) of the given trolly"""
+        if self.is_ring:
+            return int(trolly_idx), int((trolly_idx+1) % self.n)
+        return tuple(int(track) for track in self.trolly_tracks[trolly_idx])
+
+    def track_contenders(self, track_idx):
+        """return: indices of the trollies that can take the given track"""
+        return self.track_trollies[self.track_ptr[track_idx]:self.track_ptr[track_idx+1]]
+
+    def trolly_neighbors(self, trolly_idx):
+        """
+        return: (default track neighbors, alternative track neighbors), the
+                other trollies that can take each track of the given trolly,
+                single indices on a ring
+        """
+        if self.is_ring:
+            return int((trolly_idx-1) % self.n), int((trolly_idx+1) % self.n)
+        return tuple(self.track_contenders(track)[self.track_contenders(track) != trolly_idx]
+                     for track in self.trolly_tracks[trolly_idx])
+
+    def trolly_track_nums(self, track_nums):
+        """
+        track_nums: (k, num_tracks) number of people on each track
+        return: (default, alternative) (k, n) number of people on each track
+                of every trolly
+        """
+        if self.is_ring:
+            return track_nums, np.roll(track_nums, -1, axis=-1)
+        return track_nums[:, self.def_tracks], track_nums[:, self.alt_tracks]
+
+    def track_reduce(self, ufunc, edge_vals):
+        """
+        edge_vals: (k, #edges) value of every edge in track_trollies order
+        return: (k, num_tracks) ufunc reduction over every track's edges,
+                0 for the tracks without contenders
+        """
+        out = np.zeros((edge_vals.shape[0], self.num_tracks), dtype=np.int64)
+        out[:, self.used_tracks] = ufunc.reduceat(edge_vals, self.used_starts, axis=1)
+        return out
+
+    def neighbor_pass_nums(self, pass_nums):
+        """
+        pass_nums: (k, n) number of passengers on each trolly
+        return: (default, alternative) (k, n) largest number of passengers
+                among the other trollies contending for each track of every
+                trolly (0 if there is none), on a ring that is the one
+                neighbor on each track
+        """
+        if self.is_ring:
+            return np.roll(pass_nums, 1, axis=-1), np.roll(pass_nums, -1, axis=-1)
+        edge_vals = pass_nums[:, self.track_trollies].astype(np.int64)
+        top = self.track_reduce(np.maximum, edge_vals)
+        is_top = edge_vals == top[:, self.edge_tracks]
+        num_top = self.track_reduce(np.add, is_top.astype(np.int64))
+        # largest value below the top, -1 if every contender has the top
+        second = self.track_reduce(np.maximum, np.where(is_top, -1, edge_vals))
+
+        def other_max(tracks):
+            # a trolly holding the only top value sees the second largest
+            alone = (pass_nums == top[:, tracks]) & (num_top[:, tracks] == 1)
+            return np.where(alone, np.maximum(second[:, tracks], 0), top[:, tracks])
+        return other_max(self.def_tracks), other_max(self.alt_tracks)
+
+    def outcome(self, track_nums, pass_nums, decisions):
+        """
+        resolve the collisions of a batch of trials
+        track_nums: (k, num_tracks) number of people on each track
+        pass_nums: (k, n) number of passengers on each trolly
+        decisions: (k, n) decision made by each trolly (0 - stay, 1 - switch)
+        return: (pass_kills, track_kills, occupancy), see ring_outcome,
+                occupancy is (k, num_tracks)
+        """
+        if self.is_ring:
+            return ring_outcome(track_nums, pass_nums, decisions)
+        k = decisions.shape[0]
+        chosen = np.where(decisions == 0, self.def_tracks, self.alt_tracks)
+        flat_chosen = np.arange(k)[:, None] * self.num_tracks + chosen
+        occupancy = np.bincount(flat_chosen.ravel(), minlength=k*self.num_tracks) \
+            .reshape(k, self.num_tracks)
+        collided = occupancy.ravel()[flat_chosen] > 1
+        pass_kills = np.where(collided, pass_nums, 0)
+        track_kills = np.take_along_axis(track_nums, chosen, axis=1)
+        return pass_kills, track_kills, occupancy
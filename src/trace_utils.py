@@ -0,0 +1,180 @@
+"""
+Utilities for recording simulated trials to disk and re-scoring them
+
+A trace is a directory of .npy chunk files, one file per column (track_nums,
+pass_nums, decisions) and chunk, each a (trials, n) array, plus a json
+manifest listing the chunks. Replay memory-maps the chunks and recomputes the
+losses batch by batch without any agent.
+"""
+import os, json
+import numpy as np
+from sim_utils import ring_outcome
+from stats_utils import RunningStats
+
+MANIFEST = "manifest.json"
+COLUMNS = ["track_nums", "pass_nums", "decisions"]
+# number of trolly decisions per chunk file / replay batch
+CHUNK_CELLS = 2 * 10**6
+
+
+class TraceRecorder:
+    """
+    writes the trials of a Simulator to a trace directory, see
+    Simulator.enable_trace
+    """
+    def __init__(self, path, n, chunk_trials=None, meta=None):
+        """
+        path: trace directory, created if missing
+        n: number of trollies
+        chunk_trials: number of trials per chunk file, about CHUNK_CELLS
+                      decisions by default
+        meta: json serializable info saved in the manifest
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n = n
+        self.chunk_trials = chunk_trials or max(1, CHUNK_CELLS // n)
+        self.manifest = {"n": n, "columns": COLUMNS, "chunks": [],
+                         "total_trials": 0, "meta": meta or {}}
+        self.buffer = {column: [] for column in COLUMNS}
+        self.buffered = 0
+        self.write_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, track_nums, pass_nums, decisions):
+        """
+        add a batch of trials
+        track_nums, pass_nums, decisions: (k, n) arrays, see record_trials
+        """
+        for column, arr in zip(COLUMNS, [track_nums, pass_nums, decisions]):
+            self.buffer[column].append(np.array(arr, copy=True))
+        self.buffered += len(decisions)
+        if self.buffered >= self.chunk_trials:
+            self.flush(full_only=True)
+
+    def flush(self, full_only=False):
+        """
+        write the buffered trials as chunk files
+        full_only: keep the trials that don't fill a whole chunk buffered
+        """
+        if self.buffered == 0:
+            return
+        data = {column: np.concatenate(arrs) for column, arrs in self.buffer.items()}
+        start = 0
+        while self.buffered - start >= self.chunk_trials or \
+                (not full_only and start < self.buffered):
+            stop = min(start + self.chunk_trials, self.buffered)
+            self.write_chunk({column: arr[start:stop] for column, arr in data.items()})
+            start = stop
+        self.buffer = {column: [arr[start:]] for column, arr in data.items()}
+        self.buffered -= start
+        self.write_manifest()
+
+    def write_chunk(self, data):
+        chunk_idx = len(self.manifest["chunks"])
+        files = {}
+        for column, arr in data.items():
+            files[column] = f"chunk_{chunk_idx:06d}_{column}.npy"
+            np.save(os.path.join(self.path, files[column]), arr)
+        trials = len(data["decisions"])
+        self.manifest["chunks"].append({"trials": trials, "files": files})
+        self.manifest["total_trials"] += trials
+
+    def write_manifest(self):
+        """the manifest only lists complete chunks and is replaced atomically"""
+        tmp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def close(self):
+        self.flush()
+
+
+class TraceReader:
+    """memory-mapped access to a recorded trace"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.n = self.manifest["n"]
+        self.total_trials = self.manifest["total_trials"]
+        self.meta = self.manifest["meta"]
+
+    def __len__(self):
+        return self.total_trials
+
+    def iter_chunks(self):
+        """yield: {column: read-only memory-mapped (trials, n) array} per chunk"""
+        for chunk in self.manifest["chunks"]:
+            yield {column: np.load(os.path.join(self.path, file_name), mmap_mode="r")
+                   for column, file_name in chunk["files"].items()}
+
+    def iter_batches(self, batch_trials=None):
+        """
+        yield: (track_nums, pass_nums, decisions) batches of at most
+               batch_trials trials (about CHUNK_CELLS decisions by default),
+               only one batch is read into memory at a time
+        """
+        batch_trials = batch_trials or max(1, CHUNK_CELLS // self.n)
+        for chunk in self.iter_chunks():
+            for start in range(0, len(chunk["decisions"]), batch_trials):
+                yield tuple(np.asarray(chunk[column][start:start+batch_trials])
+                            for column in COLUMNS)
+
+
+def tele_loss_terms(track_nums, pass_nums, pass_kills, track_kills, occupancy):
+    """return: per-trial (people killed, people encountered)"""
+    kills = pass_kills.sum(axis=1) + (track_nums * (occupancy > 0)).sum(axis=1)
+    return kills, pass_nums.sum(axis=1) + track_nums.sum(axis=1)
+
+
+def deon_loss_terms(track_nums, pass_nums, pass_kills, track_kills, occupancy):
+    """return: per-trial (passengers killed, passengers carried)"""
+    return pass_kills.sum(axis=1), pass_nums.sum(axis=1)
+
+
+LOSS_TERMS = {"tele": tele_loss_terms, "deon": deon_loss_terms}
+
+
+def replay(path, loss_terms=None, batch_trials=None, topology=None):
+    """
+    re-score a recorded trace in one streaming pass, collisions are resolved
+    again from the recorded decisions
+    path: trace directory
+    loss_terms: {name: fn(track_nums, pass_nums, pass_kills, track_kills,
+                occupancy) -> per-trial (numerator, denominator)}, the
+                teleology and deontology losses by default
+    batch_trials: number of trials in memory at once
+    topology: track layout the trace was recorded on, a ring by default
+    return: {"trials": #trials, name: {"loss": ratio of the totals (see
+            get_tot_tele_loss), "mean", "ci_halfwidth": stats of the
+            per-trial losses}} for every loss
+    """
+    loss_terms = LOSS_TERMS if loss_terms is None else loss_terms
+    totals = {name: [0, 0] for name in loss_terms}
+    stats = {name: RunningStats() for name in loss_terms}
+    reader = TraceReader(path)
+    for track_nums, pass_nums, decisions in reader.iter_batches(batch_trials):
+        if topology is None:
+            outcome = ring_outcome(track_nums, pass_nums, decisions)
+        else:
+            outcome = topology.outcome(track_nums, pass_nums, decisions)
+        for name, fn in loss_terms.items():
+            num, den = fn(track_nums, pass_nums, *outcome)
+            totals[name][0] += num.sum()
+            totals[name][1] += den.sum()
+            sample = np.full(len(num), np.nan)
+            np.divide(num, den, out=sample, where=den > 0)
+            stats[name].update(sample)
+    result = {"trials": reader.total_trials}
+    for name, (num, den) in totals.items():
+        result[name] = {"loss": float(num / den) if den else float("nan"),
+                        "mean": float(stats[name].mean),
+                        "ci_halfwidth": stats[name].get_ci_halfwidth()}
+    return result
@@ -0,0 +1,58 @@
+import contextlib, io, os
+import numpy as np
+import pytest
+import main
+from agents_utils import StatAgent, TrackLifeAgent
+from sim_utils import Simulator, LossType
+
+
+def test_restored_simulator_continues_identically(tmp_path):
+    path = os.path.join(tmp_path, "simulator.pkl")
+    simulator = Simulator(10, 1, 0, compile_policies=True)
+    simulator.batch_set_trollies([StatAgent(0) if i % 2 else TrackLifeAgent(0)
+                                  for i in range(10)])
+    simulator.run_trials(30)
+    simulator.checkpoint(path, i_round=1)
+    simulator.run_trials(30)
+    restored, extra = Simulator.restore(path)
+    restored.run_trials(30)
+    assert extra == {"i_round": 1}
+    for name in ["trolly_pass_kills", "trolly_track_kills", "trolly_pass_tot",
+                 "trolly_track_tot", "track_nums", "trolly_pass_nums"]:
+        np.testing.assert_array_equal(getattr(restored, name), getattr(simulator, name))
+    assert vars(restored.tele_stats) == vars(simulator.tele_stats)
+
+
+@pytest.mark.parametrize("loss_type,kwargs", [
+    (LossType.TELE, {}),
+    (LossType.DEON, {"agent_stats": True, "window": 2}),
+])
+def test_resumed_mix_comp_matches_uninterrupted(tmp_path, monkeypatch, loss_type,
+                                                kwargs):
+    path = os.path.join(tmp_path, "mix_comp.pkl")
+    cell_kwargs = dict(num_round=6, num_sim=50, ratio=0.2, seed=3, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        full = main.mix_comp_cell(20, loss_type, **cell_kwargs)
+
+    # interrupt the run in its 4th round, after 3 rounds were checkpointed
+    run_trials = Simulator.run_trials
+    num_calls = [0]
+
+    def interrupted_run_trials(self, k):
+        num_calls[0] += 1
+        if num_calls[0] == 4:
+            raise KeyboardInterrupt
+        return run_trials(self, k)
+    monkeypatch.setattr(Simulator, "run_trials", interrupted_run_trials)
+    with pytest.raises(KeyboardInterrupt), contextlib.redirect_stdout(io.StringIO()):
+        main.mix_comp_cell(20, loss_type, checkpoint_path=path, **cell_kwargs)
+    assert os.path.exists(path)
+    monkeypatch.setattr(Simulator, "run_trials", run_trials)
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        resumed = main.mix_comp_cell(20, loss_type, checkpoint_path=path, **cell_kwargs)
+    assert "resume from round 4" in out.getvalue()
+    assert resumed == full
+    # a finished cell leaves no checkpoint behind to resume from
+    assert not os.path.exists(path)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from agents_utils import AlwaysDoNothingAgent, AlwaysSwitchAgent, TrackLifeAgent, \
+    StatAgent
+from sim_utils import Simulator, LossType
+from shard_utils import ShardedSimulator
+
+AGENT_CONS_ARR = [AlwaysDoNothingAgent, AlwaysSwitchAgent, TrackLifeAgent, StatAgent]
+ACCUMULATORS = ["trolly_pass_kills", "trolly_track_kills", "trolly_pass_tot",
+                "trolly_track_tot", "track_nums", "trolly_pass_nums"]
+TOTALS = ["total_pass", "total_track", "total_pass_kill", "total_track_kill",
+          "total_trials"]
+
+
+def run(simulator):
+    simulator.run_trials(50)
+    simulator.run_trial()
+    simulator.set_trolly_by_idx(0, StatAgent(0))
+    simulator.shuffle_trolly_arr()
+    simulator.run_until(0.001, 120, batch_size=40)
+
+
+@pytest.mark.parametrize("n,num_workers", [(2, 2), (7, 3), (100, 4)])
+@pytest.mark.parametrize("full_info", [0, 1])
+def test_sharded_matches_single_process(n, num_workers, full_info):
+    rng = np.random.default_rng(n)
+    agent_arr = [AGENT_CONS_ARR[i](0) for i in rng.integers(0, len(AGENT_CONS_ARR), n)]
+    single = Simulator(n, full_info, 9, compile_policies=True)
+    single.batch_set_trollies(agent_arr)
+    run(single)
+    with ShardedSimulator(n, full_info, 9, num_workers=num_workers) as sharded:
+        sharded.batch_set_trollies(agent_arr)
+        run(sharded)
+        for name in ACCUMULATORS:
+            np.testing.assert_array_equal(getattr(sharded, name), getattr(single, name))
+        for name in TOTALS:
+            assert getattr(sharded, name) == getattr(single, name)
+        assert vars(sharded.tele_stats) == vars(single.tele_stats)
+        assert vars(sharded.deon_stats) == vars(single.deon_stats)
+        assert {label: {key: vars(stats) for key, stats in label_stats.items()}
+                for label, label_stats in sharded.type_stats.items()} == \
+            {label: {key: vars(stats) for key, stats in label_stats.items()}
+             for label, label_stats in single.type_stats.items()}
+        for loss_type in LossType:
+            assert [list(idx) for idx in sharded.get_top_bot_n_trolly_idx(2, loss_type)] == \
+                [list(idx) for idx in single.get_top_bot_n_trolly_idx(2, loss_type)]